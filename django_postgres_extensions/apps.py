@@ -1,13 +1,13 @@
 from django.apps import AppConfig
 from django.conf import settings
-from django.db.models import query
-from django.db.models.signals import pre_delete
+from django.db.models import deletion, manager, query
 from django.db.models.sql import datastructures
 from django.utils.translation import ugettext_lazy as _
 
-from .models.query import update, _update, format, prefetch_one_level
+from .models.deletion import delete
+from .models.query import (update, update_returning, manager_update_returning, _update, bulk_update_values,
+                           manager_bulk_update_values, format, prefetch_one_level)
 from .models.sql.datastructures import as_sql
-from .signals import delete_reverse_related
 
 
 class PSQLExtensionsConfig(AppConfig):
@@ -17,8 +17,12 @@ class PSQLExtensionsConfig(AppConfig):
     def ready(self):
         query.QuerySet.format = format
         query.QuerySet.update = update
+        query.QuerySet.update_returning = update_returning
         query.QuerySet._update = _update
+        query.QuerySet.bulk_update_values = bulk_update_values
+        manager.BaseManager.bulk_update_values = manager_bulk_update_values
+        manager.BaseManager.update_returning = manager_update_returning
         if getattr(settings, 'ENABLE_ARRAY_M2M', False):
             datastructures.Join.as_sql = as_sql
             query.prefetch_one_level = prefetch_one_level
-            pre_delete.connect(delete_reverse_related)
+            deletion.Collector.delete = delete
@@ -1,4 +1,5 @@
 from django.db.backends.postgresql.base import DatabaseWrapper as BaseDatabaseWrapper
+from django.utils.functional import cached_property
 
 from .creation import DatabaseCreation
 from .operations import DatabaseOperations
@@ -36,3 +37,24 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             'endof': 'LIKE ALL(%s)',
             'contains': '<@ ALL(%s)'
         }
+
+    def init_connection_state(self):
+        super(DatabaseWrapper, self).init_connection_state()
+        self.clear_installed_extensions()
+
+    def clear_installed_extensions(self):
+        """
+        Forgets the cached installed extensions, so they're looked up again when
+        next needed.
+        """
+        self.__dict__.pop('installed_extensions', None)
+
+    @cached_property
+    def installed_extensions(self):
+        """
+        The names of the extensions installed in the database, so expressions can use
+        their operators when available.
+        """
+        with self.cursor() as cursor:
+            cursor.execute('SELECT extname FROM pg_extension')
+            return frozenset(row[0] for row in cursor.fetchall())
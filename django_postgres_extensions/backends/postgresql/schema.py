@@ -1,8 +1,21 @@
+from django.db.backends.ddl_references import Statement, Table
 from django.db.backends.postgresql import schema
+from django.db.models.sql import Query
+from django_postgres_extensions.models.expressions import key_text_sql
 
 
 class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
-    sql_create_array_index = "CREATE INDEX %(name)s ON %(table)s USING GIN (%(columns)s)%(extra)s"
+    sql_create_array_index = ("CREATE INDEX%(concurrently)s %(name)s ON %(table)s USING GIN (%(columns)s)%(storage)s"
+                              "%(extra)s%(condition)s")
+    sql_delete_array_index = "DROP INDEX%(concurrently)s IF EXISTS %(name)s"
+    sql_rename_array_index = "ALTER INDEX %(old_name)s RENAME TO %(new_name)s"
+    sql_create_key_index = "CREATE INDEX %(name)s ON %(table)s ((%(expression)s))"
+
+    def execute(self, sql, params=()):
+        super(DatabaseSchemaEditor, self).execute(sql, params)
+        if 'EXTENSION' in str(sql).upper():
+            # e.g. CreateExtension, after which expressions may use the extension's operators
+            self.connection.clear_installed_extensions()
 
     def _model_indexes_sql(self, model):
         output = super(DatabaseSchemaEditor, self)._model_indexes_sql(model)
@@ -13,10 +26,141 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
             array_index_statement = self._create_array_index_sql(model, field)
             if array_index_statement is not None:
                 output.append(array_index_statement)
+            output.extend(self._key_indexes_sql(model, field))
         return output
 
-    def _create_array_index_sql(self, model, field):
+    def add_field(self, model, field):
+        super(DatabaseSchemaEditor, self).add_field(model, field)
+        array_index_statement = self._create_array_index_sql(model, field)
+        if array_index_statement is not None:
+            self.deferred_sql.append(array_index_statement)
+        self.deferred_sql.extend(self._key_indexes_sql(model, field))
+
+    def _alter_field(self, model, old_field, new_field, old_type, new_type,
+                     old_db_params, new_db_params, strict=False):
+        old_options = self._array_index_options(model, old_field)
+        new_options = self._array_index_options(model, new_field)
+        renamed = old_field.column != new_field.column
+        if old_options is not None and old_options != new_options:
+            self.execute(self._delete_array_index_sql(model, old_field))
+        old_key_indexes = self._key_index_options(old_field)
+        new_key_indexes = self._key_index_options(new_field)
+        for options in old_key_indexes:
+            if renamed or options not in new_key_indexes:
+                self.execute(self._delete_key_index_sql(model, old_field, options))
+        super(DatabaseSchemaEditor, self)._alter_field(model, old_field, new_field, old_type, new_type,
+                                                       old_db_params, new_db_params, strict)
+        if new_options is not None and old_options != new_options:
+            self.execute(self._create_array_index_sql(model, new_field))
+        elif new_options is not None and renamed:
+            # Postgres follows the column rename, only the index name is stale
+            self.execute(self._rename_array_index_sql(model, old_field, new_field))
+        for options in new_key_indexes:
+            if renamed or options not in old_key_indexes:
+                self.execute(self._create_key_index_sql(model, new_field, options))
+
+    def _has_array_index(self, field):
         db_type = field.db_type(connection=self.connection)
-        if db_type is not None and '[' in db_type and db_type.endswith(']') and (field.db_index or field.unique):
-            return self._create_index_sql(model, [field], suffix='_gin', sql=self.sql_create_array_index)
-        return None
+        return db_type is not None and '[' in db_type and db_type.endswith(']') and (field.db_index or field.unique)
+
+    def _array_index_options(self, model, field):
+        """
+        Returns the options of the GIN index of an array field as
+        (opclass, storage parameters, condition), or None if it has no index.
+        """
+        if not self._has_array_index(field):
+            return None
+        opclass = getattr(field, 'index_opclass', None)
+        if opclass is None and getattr(field, 'uses_intarray', None) and field.uses_intarray(self.connection):
+            opclass = 'gin__int_ops'
+        storage = []
+        fastupdate = getattr(field, 'fastupdate', None)
+        if fastupdate is not None:
+            storage.append('fastupdate = %s' % ('on' if fastupdate else 'off'))
+        pending_list_limit = getattr(field, 'gin_pending_list_limit', None)
+        if pending_list_limit is not None:
+            storage.append('gin_pending_list_limit = %d' % pending_list_limit)
+        condition = getattr(field, 'index_condition', None)
+        if condition is not None and hasattr(condition, 'resolve_expression'):
+            query = Query(model=model)
+            where = query.build_where(condition)
+            sql, params = where.as_sql(query.get_compiler(connection=self.connection), self.connection)
+            condition = sql % tuple(self.quote_value(param) for param in params)
+        return opclass, tuple(storage), condition
+
+    def _array_index_concurrently(self, field):
+        # Indexes can only be built concurrently outside of a transaction, so
+        # migrations which should do so need atomic = False.
+        return getattr(field, 'index_concurrently', False) and not self.connection.in_atomic_block
+
+    def _create_array_index_sql(self, model, field, concurrently=None):
+        options = self._array_index_options(model, field)
+        if options is None:
+            return None
+        opclass, storage, condition = options
+        statement = self._create_index_sql(model, [field], suffix='_gin', sql=self.sql_create_array_index,
+                                           opclasses=[opclass] if opclass else (), condition=condition)
+        if concurrently is None:
+            concurrently = self._array_index_concurrently(field)
+        statement.parts['concurrently'] = ' CONCURRENTLY' if concurrently else ''
+        statement.parts['storage'] = ' WITH (%s)' % ', '.join(storage) if storage else ''
+        return statement
+
+    def _delete_array_index_sql(self, model, field, concurrently=None):
+        statement = self._delete_index_sql(model, self._create_index_name(model._meta.db_table, [field.column],
+                                                                          suffix='_gin'))
+        if concurrently is None:
+            concurrently = self._array_index_concurrently(field)
+        statement.template = self.sql_delete_array_index
+        statement.parts['concurrently'] = ' CONCURRENTLY' if concurrently else ''
+        return statement
+
+    def _rename_array_index_sql(self, model, old_field, new_field):
+        table = model._meta.db_table
+        return Statement(
+            self.sql_rename_array_index,
+            old_name=self.quote_name(self._create_index_name(table, [old_field.column], suffix='_gin')),
+            new_name=self.quote_name(self._create_index_name(table, [new_field.column], suffix='_gin')),
+        )
+
+    def _key_index_options(self, field):
+        """
+        Returns the indexes declared on the keys of a hstore or jsonb field as
+        ('key', path, cast) and on its whole value as ('gin' or 'gist', opclass).
+        """
+        options = []
+        if not getattr(field, 'key_indexes', None) and not getattr(field, 'containment_index', None):
+            return options
+        for path, cast in field.key_index_casts.items():
+            options.append(('key', path, cast))
+        if field.containment_index:
+            options.append((field.containment_index.lower(), field.index_opclass))
+        return options
+
+    def _key_index_name(self, model, field, options):
+        if options[0] == 'key':
+            return self._create_index_name(model._meta.db_table, [field.column] + list(options[1]), suffix='_key')
+        return self._create_index_name(model._meta.db_table, [field.column], suffix='_%s' % options[0])
+
+    def _create_key_index_sql(self, model, field, options):
+        if options[0] != 'key':
+            method, opclass = options
+            return self._create_index_sql(model, [field], suffix='_%s' % method, using=' USING %s' % method.upper(),
+                                          opclasses=[opclass] if opclass else ())
+        # The expression has to be the one Key and the lookups on the key compile
+        # to, so queries on the key can use the index.
+        path, cast = options[1:]
+        sql, params = key_text_sql(self.quote_name(field.column), list(path),
+                                   json=field.get_internal_type() == 'JSONField', cast=cast or None)
+        return Statement(
+            self.sql_create_key_index,
+            table=Table(model._meta.db_table, self.quote_name),
+            name=self.quote_name(self._key_index_name(model, field, options)),
+            expression=sql % tuple(self.quote_value(param) for param in params),
+        )
+
+    def _delete_key_index_sql(self, model, field, options):
+        return self._delete_index_sql(model, self._key_index_name(model, field, options))
+
+    def _key_indexes_sql(self, model, field):
+        return [self._create_key_index_sql(model, field, options) for options in self._key_index_options(field)]
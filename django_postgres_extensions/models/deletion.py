@@ -0,0 +1,79 @@
+from django.db import transaction
+from django.db.models import signals
+from django.db.models.deletion import Collector
+
+from .functions import ArrayRemoveMany
+
+base_delete = Collector.delete
+
+_array_references = {}
+
+
+def get_array_references(model):
+    """
+    Returns the ArrayManyToManyFields which reference the given model. The result is
+    cached per model so deleting models without incoming array relations costs nothing.
+    """
+    model = model._meta.concrete_model
+    try:
+        return _array_references[model]
+    except KeyError:
+        fields = [related.field for related in model._meta.get_fields(include_hidden=True)
+                  if related.auto_created and not related.concrete and
+                  getattr(related.field, 'many_to_many_array', False)]
+        _array_references[model] = fields
+        return fields
+
+
+def remove_array_references(field, values, using):
+    """
+    Removes all the values from the field's array column with a single UPDATE of the
+    rows which overlap with them.
+    """
+    filters = {'%s__overlap' % field.attname: values}
+    kwargs = {field.attname: ArrayRemoveMany(field.attname, values, output_field=field)}
+    field.model._base_manager.using(using).filter(**filters).update(**kwargs)
+
+
+def send_clear_signals(action, field, instances, using):
+    """
+    Sends the m2m_changed clear signal for each deleted instance, as clearing the reverse
+    relation of every instance before deleting it used to.
+    """
+    for obj in instances:
+        signals.m2m_changed.send(
+            sender=field.model, action=action, instance=obj, reverse=True,
+            model=field.model, pk_set=None, using=using,
+        )
+
+
+def clear_array_references(field, instances, using):
+    target = field.target_field
+    values = [getattr(obj, target.attname) for obj in instances]
+    if values:
+        send_clear_signals('pre_clear', field, instances, using)
+        remove_array_references(field, values, using)
+        send_clear_signals('post_clear', field, instances, using)
+
+
+def delete(self):
+    """
+    Replacement for Collector.delete which first removes the objects being deleted
+    from any array many to many fields referencing them, with one UPDATE per field
+    for the whole delete rather than one per deleted instance. The pre_clear and
+    post_clear m2m_changed signals are still sent for each deleted instance.
+    """
+    with transaction.atomic(using=self.using, savepoint=False):
+        for model, instances in self.data.items():
+            for field in get_array_references(model):
+                clear_array_references(field, instances, self.using)
+        for qs in self.fast_deletes:
+            for field in get_array_references(qs.model):
+                if signals.m2m_changed.has_listeners(field.model):
+                    # The clear signals need the instances
+                    clear_array_references(field, list(qs), self.using)
+                    continue
+                values = list(qs.values_list(field.target_field.attname, flat=True))
+                if values:
+                    remove_array_references(field, values, self.using)
+        return base_delete(self)
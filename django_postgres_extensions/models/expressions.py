@@ -1,5 +1,7 @@
 from django.contrib.postgres.fields.array import IndexTransform
-from django.db.models.expressions import F as BaseF, Value as BaseValue, Expression
+from django.db.models import fields
+from django.db.models.expressions import F as BaseF, Func, Value as BaseValue, CombinedExpression, Expression
+from django.db.models.functions import Cast
 from django.db.models.lookups import Transform
 from django.utils import six
 from django.utils.functional import cached_property
@@ -35,6 +37,12 @@ class OperatorMixin(object):
     def pathtext(self, other):
         return self._combine(other, self.PATHTEXT, False)
 
+    def increment(self, key, amount=1, default=0):
+        return Increment(self, {key: amount}, default=default)
+
+    def increment_many(self, amounts, default=0):
+        return Increment(self, amounts, default=default)
+
 
 class F(BaseF, OperatorMixin):
     pass
@@ -98,17 +106,295 @@ class SliceArray(Transform):
         return self.lhs.field.base_field
 
 
-def Key(field, keys_string):
-    if isinstance(keys_string, six.string_types) and '__' in keys_string:
+# The fields for the values of keys cast to these types
+KEY_CAST_FIELDS = {
+    'text': fields.TextField,
+    'integer': fields.IntegerField,
+    'bigint': fields.BigIntegerField,
+    'double precision': fields.FloatField,
+    'boolean': fields.BooleanField,
+    'date': fields.DateField,
+    'timestamp with time zone': fields.DateTimeField,
+}
+
+# Other names of the types above, which Postgres would otherwise keep apart when
+# matching queries to expression indexes
+KEY_CAST_ALIASES = {
+    'int': 'integer',
+    'int4': 'integer',
+    'int8': 'bigint',
+    'float': 'double precision',
+    'float8': 'double precision',
+    'bool': 'boolean',
+    'timestamptz': 'timestamp with time zone',
+}
+
+
+def canonical_cast(cast):
+    """
+    Returns the name a key is cast to in both queries and indexes, '' for text.
+    """
+    if not cast:
+        return ''
+    cast = ' '.join(cast.lower().split())
+    cast = KEY_CAST_ALIASES.get(cast, cast)
+    return '' if cast == 'text' else cast
+
+
+# Casts from text which Postgres marks IMMUTABLE, so only these can be used in an
+# expression index. Dates and timestamps depend on DateStyle and the time zone.
+IMMUTABLE_KEY_CASTS = ('', 'integer', 'smallint', 'bigint', 'real', 'double precision', 'numeric', 'boolean')
+
+
+def is_immutable_cast(cast):
+    cast = canonical_cast(cast)
+    return cast in IMMUTABLE_KEY_CASTS or cast.startswith('numeric(')
+
+
+def key_text_sql(column_sql, path, json=True, cast=None):
+    """
+    Returns the SQL and params for the text value at a key of a hstore, or a key
+    path of a jsonb value, cast to cast if given: ((column ->> 'key'))::cast. This
+    is the form of both expression indexes and the queries which should use them.
+    """
+    if not json:
+        if len(path) != 1:
+            raise ValueError('Key paths are only supported in JSON fields')
+        sql, param = '(%s -> %%s)' % column_sql, path[0]
+    elif len(path) == 1:
+        sql, param = '(%s ->> %%s)' % column_sql, path[0]
+        if param.isdigit():
+            param = int(param)
+    else:
+        sql = '(%s #>> %%s)' % column_sql
+        param = '{%s}' % ','.join('"%s"' % key.replace('\\', '\\\\').replace('"', '\\"') for key in path)
+    if cast:
+        sql = '(%s)::%s' % (sql, cast)
+    return sql, [param]
+
+
+class KeyText(Expression):
+    """
+    The text value at a key (or key path, given as a list or a string with keys
+    separated by __) of a hstore or jsonb expression, optionally cast to a database
+    type. Keys declared in the key_indexes of a field are queried with this
+    expression so that the expression index can be used.
+    """
+
+    def __init__(self, expression, path, cast=None, output_field=None):
+        if not isinstance(expression, (Expression, BaseF)):
+            expression = F(expression)
+        if isinstance(path, six.string_types):
+            path = path.split('__')
+        cast = canonical_cast(cast) or None
+        if output_field is None:
+            if (cast or 'text') not in KEY_CAST_FIELDS:
+                raise ValueError('An output_field is needed for keys cast to %s' % cast)
+            output_field = KEY_CAST_FIELDS[cast or 'text']()
+        super(KeyText, self).__init__(output_field=output_field)
+        self.expression = expression
+        self.path = [six.text_type(key) for key in path]
+        self.cast = cast
+
+    def get_cast(self, connection):
+        """
+        Returns the type the text value is cast to, which is the database type of the
+        output_field unless cast is given.
+        """
+        if self.cast is not None:
+            return self.cast
+        if self.output_field.get_internal_type() in ('CharField', 'TextField'):
+            return None
+        return canonical_cast(self.output_field.db_type(connection)) or None
+
+    def get_source_expressions(self):
+        return [self.expression]
+
+    def set_source_expressions(self, exprs):
+        self.expression, = exprs
+
+    def get_transform(self, name):
+        transform = super(KeyText, self).get_transform(name)
+        key_transform = getattr(self, 'key_transform', None)
+        if transform is None and key_transform is not None:
+            # Keys below an indexed key are taken from the original value
+            return key_transform.get_transform(name)
+        return transform
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.expression)
+        json = self.expression.output_field.get_internal_type() == 'JSONField'
+        sql, key_params = key_text_sql(sql, self.path, json=json, cast=self.get_cast(connection))
+        return sql, list(params) + key_params
+
+
+class KeyTextTransformFactory(object):
+    """
+    Wraps the key transform factory of a field with key_indexes, so a filter on
+    a declared key compares the KeyText of its index rather than the raw value.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, lhs, *args, **kwargs):
+        transform = self.factory(getattr(lhs, 'key_transform', lhs), *args, **kwargs)
+        path, base = [], transform
+        while hasattr(base, 'key_name'):
+            path.insert(0, six.text_type(base.key_name))
+            base = base.lhs
+        field = base.output_field
+        key_index = field.get_key_index(path) if getattr(field, 'key_indexes', None) else None
+        if key_index is None:
+            return transform
+        expression = KeyText(base, path, cast=key_index)
+        expression.key_transform = transform
+        return expression
+
+
+class KeyExpression(CombinedExpression):
+    """
+    The value at a key or key path, which resolves to the KeyText of the key
+    index if the field declares one for the key.
+    """
+
+    def __init__(self, field, path, connector, value, **kwargs):
+        super(KeyExpression, self).__init__(F(field), connector, value, **kwargs)
+        self.key_path = path
+
+    def resolve_expression(self, *args, **kwargs):
+        resolved = super(KeyExpression, self).resolve_expression(*args, **kwargs)
+        field = resolved.lhs.output_field
+        if getattr(field, 'key_indexes', None):
+            key_index = field.get_key_index(self.key_path)
+            if key_index is not None:
+                return KeyText(resolved.lhs, self.key_path, cast=key_index)
+        return resolved
+
+
+def Key(field, keys_string, output_field=None, cast=None):
+    if output_field is not None or cast is not None:
+        # Typed values are the text at the key cast in the database, the same
+        # expression as a key index with that cast.
+        path = keys_string.split('__') if isinstance(keys_string, six.string_types) else [keys_string]
+        expression = KeyText(field, path, cast=cast, output_field=output_field)
+    elif isinstance(keys_string, six.string_types) and '__' in keys_string:
         keys = keys_string.split('__')
-        expression = F(field).path(Value(keys))
+        expression = KeyExpression(field, keys, OperatorMixin.PATH, Value(keys))
     else:
-        expression = F(field).key(Value(keys_string))
+        expression = KeyExpression(field, [keys_string], OperatorMixin.KEY, Value(keys_string))
     expression.default_alias = "%s__%s" % (field, keys_string)
     return expression
 
 
-def Keys(field, keys):
+def KeyInt(field, keys_string):
+    return Key(field, keys_string, output_field=fields.IntegerField())
+
+
+def KeyFloat(field, keys_string):
+    return Key(field, keys_string, output_field=fields.FloatField())
+
+
+def KeyBool(field, keys_string):
+    return Key(field, keys_string, output_field=fields.BooleanField())
+
+
+def KeyTimestamp(field, keys_string):
+    # Timestamp casts aren't immutable, so these can't be matched to a key index
+    return Key(field, keys_string, output_field=fields.DateTimeField())
+
+
+def Keys(field, keys, output_field=None):
     expression = F(field).key(Value(keys))
+    if output_field is not None:
+        from django.contrib.postgres.fields import ArrayField
+        expression = Cast(expression, ArrayField(output_field))
     expression.default_alias = "%s__selected" % field
     return expression
+
+
+def json_parents_sql(sql, doc_sql, paths):
+    """
+    Wraps sql, a jsonb document, in JSONB_SET calls creating the objects missing
+    along each of paths, which JSONB_SET doesn't do itself. Existing parents are read
+    from doc_sql, the document before the update. Returns the SQL and the params
+    which follow those of sql.
+    """
+    prefixes = []
+    for path in paths:
+        for length in range(1, len(path)):
+            if list(path[:length]) not in prefixes:
+                prefixes.append(list(path[:length]))
+    params = []
+    for prefix in sorted(prefixes, key=len):
+        sql = "JSONB_SET(%s, %%s::text[], COALESCE(%s #> %%s::text[], '{}'::jsonb))" % (sql, doc_sql)
+        params.extend([prefix, prefix])
+    return sql, params
+
+
+class Increment(Func):
+    """
+    Increments the numbers stored at the keys of a hstore or jsonb value in the
+    database, starting from default when a key (or the whole value) is missing.
+    amounts maps keys to the amount to add; for jsonb a key may also be a path, given
+    as a list or with keys separated by __ as in 'counters__views'. Several top level
+    keys are incremented with a single UNNEST of two arrays. The value is read once in
+    a subquery, so the SQL doesn't repeat it however many keys are incremented.
+    """
+    template = "(SELECT %(expression)s FROM (SELECT COALESCE(%(field)s, '%(empty)s') AS doc) AS incremented)"
+    hstore_single = "%(doc)s || HSTORE(%%s, (COALESCE((incremented.doc -> %%s)::numeric, %%s) + %%s)::text)"
+    hstore_many = (
+        "%(doc)s || (SELECT HSTORE(ARRAY_AGG(increment.key), ARRAY_AGG((COALESCE((incremented.doc -> increment.key)"
+        "::numeric, %%s) + increment.amount)::text)) FROM UNNEST(%%s::text[], %%s::numeric[]) AS increment (key, amount))"
+    )
+    json_single = "%(doc)s || JSONB_BUILD_OBJECT(%%s, COALESCE((incremented.doc ->> %%s)::numeric, %%s) + %%s)"
+    json_many = (
+        "%(doc)s || (SELECT JSONB_OBJECT_AGG(increment.key, COALESCE((incremented.doc ->> increment.key)::numeric, %%s) "
+        "+ increment.amount) FROM UNNEST(%%s::text[], %%s::numeric[]) AS increment (key, amount))"
+    )
+    json_path = ("JSONB_SET(%(doc)s, %%s::text[], "
+                 "TO_JSONB(COALESCE((incremented.doc #>> %%s::text[])::numeric, %%s) + %%s))")
+
+    def __init__(self, expression, amounts, default=0, **extra):
+        self.amounts = list(amounts.items())
+        self.default = default
+        super(Increment, self).__init__(expression, **extra)
+
+    @staticmethod
+    def get_path(key, is_json):
+        if isinstance(key, (list, tuple)):
+            path = [six.text_type(part) for part in key]
+        elif is_json:
+            path = six.text_type(key).split('__')
+        else:
+            # Keys of a hstore are never paths, whatever they contain
+            path = [key]
+        if len(path) > 1 and not is_json:
+            raise ValueError('Key paths can only be incremented in JSON fields')
+        return path
+
+    def as_sql(self, compiler, connection):
+        field_sql, field_params = compiler.compile(self.source_expressions[0])
+        is_json = self.output_field.get_internal_type() == 'JSONField'
+        keys, paths = [], []
+        for key, amount in self.amounts:
+            path = self.get_path(key, is_json)
+            if len(path) == 1:
+                keys.append((path[0], amount))
+            else:
+                paths.append((path, amount))
+        sql, params = 'incremented.doc', []
+        if len(keys) == 1:
+            key, amount = keys[0]
+            sql = (self.json_single if is_json else self.hstore_single) % {'doc': sql}
+            params = params + [key, key, self.default, amount]
+        elif keys:
+            sql = (self.json_many if is_json else self.hstore_many) % {'doc': sql}
+            params = params + [self.default, [key for key, amount in keys], [amount for key, amount in keys]]
+        sql, parent_params = json_parents_sql(sql, 'incremented.doc', [path for path, amount in paths])
+        params.extend(parent_params)
+        for path, amount in paths:
+            sql = self.json_path % {'doc': sql}
+            params = params + [path, path, self.default, amount]
+        sql = self.template % {'expression': sql, 'field': field_sql, 'empty': '{}' if is_json else ''}
+        return sql, params + list(field_params)
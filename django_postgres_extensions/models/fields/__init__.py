@@ -1,20 +1,46 @@
+from collections import OrderedDict
+
+from django.conf import settings
 from django.contrib.postgres import fields
 from django.contrib.postgres.forms import SplitArrayField as SplitArrayFormField
-from django.core import exceptions
+from django.core import checks, exceptions
 from django.forms.fields import TypedMultipleChoiceField
+from django.utils import six
+from django.utils.functional import cached_property
 from psycopg2.extras import Json
 
 from django_postgres_extensions.forms.fields import NestedFormField
-from django_postgres_extensions.models.expressions import F, Value as V
-from django_postgres_extensions.models.functions import HStore, Delete, ArrayRemove
+from django_postgres_extensions.models.expressions import (F, Increment, KeyTextTransformFactory, OperatorMixin,
+                                                           Value as V, canonical_cast, is_immutable_cast)
+from django_postgres_extensions.models.functions import (HStore, HStorePatch, Delete, ArrayRemove, JSONBSetPath,
+                                                         JSONBIncrement, JSONBAppend)
 from django_postgres_extensions.models.sql.updates import UpdateArrayByIndex
 
 
 class ArrayField(fields.ArrayField):
 
-    def __init__(self, base_field, form_size=None, **kwargs):
+    index_options = ('index_opclass', 'fastupdate', 'gin_pending_list_limit', 'index_condition')
+
+    def __init__(self, base_field, form_size=None, intarray=None, index_opclass=None, fastupdate=None,
+                 gin_pending_list_limit=None, index_condition=None, index_concurrently=False, **kwargs):
         super(ArrayField, self).__init__(base_field, **kwargs)
         self.form_size = form_size
+        self.intarray = intarray
+        self.index_opclass = index_opclass
+        self.fastupdate = fastupdate
+        self.gin_pending_list_limit = gin_pending_list_limit
+        self.index_condition = index_condition
+        self.index_concurrently = index_concurrently
+
+    def uses_intarray(self, connection):
+        """
+        Whether the operators and gin__int_ops operator class of the intarray
+        extension are used for this field. The field must be an integer array opted in
+        with intarray=True (or the USE_INTARRAY setting) and the extension installed.
+        """
+        intarray = self.intarray if self.intarray is not None else getattr(settings, 'USE_INTARRAY', False)
+        return (bool(intarray) and self.db_type(connection) == 'integer[]' and
+                'intarray' in getattr(connection, 'installed_extensions', ()))
 
     def get_update_type(self, indexes, value):
         if indexes == 'del':
@@ -22,11 +48,22 @@ class ArrayField(fields.ArrayField):
         if '__' in indexes:
             indexes = indexes.split('__')
         try:
-            indexes = [int(index) + 1 for index in indexes]
+            indexes = [self.get_update_index(index) for index in indexes]
             return UpdateArrayByIndex(indexes, value, self)
         except ValueError:
             raise ValueError('Update lookup type %s not found for field %s' % (indexes, self.name))
 
+    @staticmethod
+    def get_update_index(index):
+        """
+        Converts a zero based index, or a start_end slice as used by SliceArray, to
+        the database's one based subscript.
+        """
+        if '_' in index:
+            start, end = index.split('_')
+            return int(start) + 1, int(end) + 1
+        return int(index) + 1
+
     def formfield(self, **kwargs):
         if self.form_size or self.choices:
             defaults = {
@@ -83,10 +120,77 @@ class ArrayField(fields.ArrayField):
         kwargs.update({
             'form_size': self.form_size,
         })
+        if self.intarray is not None:
+            kwargs['intarray'] = self.intarray
+        for option in self.index_options:
+            if getattr(self, option) is not None:
+                kwargs[option] = getattr(self, option)
+        if self.index_concurrently:
+            kwargs['index_concurrently'] = True
         return name, path, args, kwargs
 
 
-class HStoreField(fields.HStoreField):
+class KeyIndexMixin(object):
+    """
+    Declares indexes on a hstore or jsonb field. key_indexes lists keys (or key
+    paths) to index the text value of, or (key, type) pairs to index the value cast
+    to a database type; filters and Key expressions on those keys query the same
+    expression. containment_index ('gin', or 'gist' for hstore) with an optional
+    index_opclass such as jsonb_path_ops indexes the whole value.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.key_indexes = list(kwargs.pop('key_indexes', ()))
+        self.containment_index = kwargs.pop('containment_index', None)
+        self.index_opclass = kwargs.pop('index_opclass', None)
+        super(KeyIndexMixin, self).__init__(*args, **kwargs)
+
+    @cached_property
+    def key_index_casts(self):
+        casts = OrderedDict()
+        for key_index in self.key_indexes:
+            path, cast = key_index if isinstance(key_index, (list, tuple)) else (key_index, '')
+            casts[tuple(path.split('__'))] = canonical_cast(cast)
+        return casts
+
+    def check(self, **kwargs):
+        errors = super(KeyIndexMixin, self).check(**kwargs)
+        for path, cast in self.key_index_casts.items():
+            if not is_immutable_cast(cast):
+                errors.append(checks.Error(
+                    "Key index '%s' can't be cast to %s in an index." % ('__'.join(path), cast),
+                    hint='Postgres only allows immutable casts in expression indexes, such as integer, bigint, '
+                         'double precision, numeric or boolean. Keys can still be cast to %s in queries.' % cast,
+                    obj=self,
+                    id='django_postgres_extensions.E001',
+                ))
+        return errors
+
+    def get_key_index(self, path):
+        """
+        Returns the type the key path is cast to in its index ('' for text), or None
+        if it isn't indexed.
+        """
+        return self.key_index_casts.get(tuple(six.text_type(key) for key in path))
+
+    def get_transform(self, name):
+        transform = super(KeyIndexMixin, self).get_transform(name)
+        if self.key_indexes and hasattr(transform, 'key_name'):
+            return KeyTextTransformFactory(transform)
+        return transform
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(KeyIndexMixin, self).deconstruct()
+        if self.key_indexes:
+            kwargs['key_indexes'] = self.key_indexes
+        if self.containment_index:
+            kwargs['containment_index'] = self.containment_index
+        if self.index_opclass:
+            kwargs['index_opclass'] = self.index_opclass
+        return name, path, args, kwargs
+
+
+class HStoreField(KeyIndexMixin, fields.HStoreField):
 
     def __init__(self, fields=(), keys=(), max_value_length=25, require_all_fields=False, **kwargs):
         super(HStoreField, self).__init__(**kwargs)
@@ -95,16 +199,30 @@ class HStoreField(fields.HStoreField):
         self.max_value_length = max_value_length
         self.require_all_fields = require_all_fields
 
-    def get_update_type(self, lookups, value):
+    # Several update lookups on the field are applied one after the other in a single expression
+    chain_updates = True
+
+    def get_update_type(self, lookups, value, base=None):
         lookup = lookups[0]
+        if base is None:
+            base = F(self.name)
         if lookup == '' or lookup == 'raw':
             keys = list(value.keys())
             values = list(value.values())
             if lookup == '':
                 values = [str(v) for v in value.values()]
-            return F(self.name).cat(HStore(V(keys), V(values)))
+            return base._combine(HStore(V(keys), V(values)), OperatorMixin.CAT, False)
         if lookup == 'del':
-            return Delete(self.name, value)
+            return Delete(base, V(value))
+        if lookup == 'patch':
+            return HStorePatch(base, value, output_field=self)
+        if lookup == 'inc' and len(lookups) == 2:
+            if isinstance(base, Increment):
+                # Increment all the keys with a single UNNEST
+                amounts = OrderedDict(base.amounts)
+                amounts[lookups[1]] = value
+                return Increment(base.source_expressions[0], amounts, default=base.default, output_field=self)
+            return Increment(base, {lookups[1]: value}, output_field=self)
         raise ValueError('Update lookup type %s not found for field %s' % (lookup, self.name))
 
     def formfield(self, **kwargs):
@@ -122,22 +240,33 @@ class HStoreField(fields.HStoreField):
         return super(HStoreField, self).formfield(**defaults)
 
 
-class JSONField(fields.JSONField):
+class JSONField(KeyIndexMixin, fields.JSONField):
 
     def __init__(self, fields=(), require_all_fields=False, **kwargs):
         super(JSONField, self).__init__(**kwargs)
         self.fields = fields
         self.require_all_fields = require_all_fields
 
-    def get_update_type(self, lookups, value):
-        lookup = lookups[0]
+    # Several update lookups on the field are applied one after the other in a single expression
+    chain_updates = True
+
+    def get_update_type(self, lookups, value, base=None):
+        lookup, path = lookups[0], lookups[1:]
+        if base is None:
+            base = F(self.name)
         if lookup == '':
-            return F(self.name).cat(V(Json(value)))
+            return base._combine(V(Json(value)), OperatorMixin.CAT, False)
         if lookup == 'del':
             if '__' in value:
                 values = value.split('__')
-                return F(self.name).delete(V(values))
-            return F(self.name) - V(value)
+                return base._combine(V(values), OperatorMixin.DELETE, False)
+            return base - V(value)
+        if lookup in ('set', 'inc', 'append') and path:
+            if lookup == 'set':
+                return JSONBSetPath(base, path, value, output_field=self)
+            if lookup == 'inc':
+                return JSONBIncrement(base, path, value, output_field=self)
+            return JSONBAppend(base, path, value, output_field=self)
         raise ValueError('Update lookup type %s not found for field %s' % (lookup, self.name))
 
     def formfield(self, **kwargs):
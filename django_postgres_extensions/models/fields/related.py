@@ -24,8 +24,12 @@ class ArrayManyToManyField(ArrayField, RelatedField):
 
     rel_class = ArrayManyToManyRel
 
+    prefetch_strategies = ('in', 'unnest')
+    join_strategies = ('auto', 'any', 'unnest')
+
     def __init__(self, to_model, base_field=None, size=None, related_name=None, symmetrical=None,
-                 related_query_name=None, limit_choices_to=None, to_field=None, db_constraint=False, **kwargs):
+                 related_query_name=None, limit_choices_to=None, to_field=None, db_constraint=False,
+                 prefetch_strategy='in', join_strategy='auto', **kwargs):
 
         try:
             to = to_model._meta.model_name
@@ -74,6 +78,16 @@ class ArrayManyToManyField(ArrayField, RelatedField):
 
         self.db_constraint = db_constraint
 
+        if prefetch_strategy not in self.prefetch_strategies:
+            raise ValueError("prefetch_strategy must be one of %s, got %r" % (
+                ', '.join(self.prefetch_strategies), prefetch_strategy))
+        self.prefetch_strategy = prefetch_strategy
+
+        if join_strategy not in self.join_strategies:
+            raise ValueError("join_strategy must be one of %s, got %r" % (
+                ', '.join(self.join_strategies), join_strategy))
+        self.join_strategy = join_strategy
+
         self.to = to
 
         if 'default' not in kwargs.keys():
@@ -96,7 +110,9 @@ class ArrayManyToManyField(ArrayField, RelatedField):
             'related_query_name': self.remote_field.related_query_name,
             'limit_choices_to': self.remote_field.limit_choices_to,
             'to_field': self.remote_field.field,
-            'db_constraint': self.db_constraint
+            'db_constraint': self.db_constraint,
+            'prefetch_strategy': self.prefetch_strategy,
+            'join_strategy': self.join_strategy,
         })
         return name, path, args, kwargs
 
@@ -173,6 +189,8 @@ class ArrayManyToManyField(ArrayField, RelatedField):
         return super(RelatedField, self).formfield(**defaults)
 
     def get_join_on(self, parent_alias, lhs_col, table_alias, rhs_col):
+        if self.join_strategy == 'unnest':
+            return '%s.%s = %s.value' % (table_alias, rhs_col, self.get_unnest_alias(table_alias))
         return '%s.%s = ANY(%s.%s)' % (
             table_alias,
             rhs_col,
@@ -180,6 +198,21 @@ class ArrayManyToManyField(ArrayField, RelatedField):
             lhs_col,
         )
 
+    def get_join_prefix(self, join_type, parent_alias, lhs_col, table_alias):
+        """
+        With the unnest join strategy, the array is unnested with a LATERAL join before
+        the related table is joined against its values, which lets the database hash
+        join large arrays rather than checking each related row against the array.
+        """
+        if self.join_strategy == 'unnest':
+            return '%s LATERAL UNNEST(%s.%s) AS %s (value) ON TRUE ' % (
+                join_type, parent_alias, lhs_col, self.get_unnest_alias(table_alias))
+        return ''
+
+    @staticmethod
+    def get_unnest_alias(table_alias):
+        return '"%s_unnest"' % table_alias.strip('"')
+
     def get_join_on2(self, parent_alias, lhs_col, table_alias, rhs_col):
         return "ARRAY_APPEND(ARRAY[]::integer[], %s.%s) <@ ANY(%s.%s)" % (
             table_alias,
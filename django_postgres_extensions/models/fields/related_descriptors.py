@@ -1,8 +1,13 @@
-from django.db import transaction, router
+from collections import OrderedDict
+
+from django.db import models, transaction, router, connections
 from django.db.models import signals
+from django.db.models.sql.constants import INNER
 from django.utils.functional import cached_property
 
-from django_postgres_extensions.models.functions import ArrayCat, ArrayRemove, multi_array_remove
+from django_postgres_extensions.models.functions import ArrayCat, ArrayCatUnique, ArrayRemove, ArrayRemoveMany
+from django_postgres_extensions.models.sql.datastructures import ArrayUnnestJoin
+from django_postgres_extensions.signals import m2m_bulk_changed
 from django_postgres_extensions.utils import OrderedSet
 
 
@@ -38,6 +43,171 @@ class MultiReferenceDescriptor(object):
             self.isJson
         )
 
+    def _get_bulk_mapping(self, mapping):
+        """
+        Normalise a {pk: objs} mapping to {pk of the model with the array field: related pks},
+        inverting it for reverse relations.
+        """
+        field = self.rel.field
+        result = OrderedDict()
+        for key, objs in mapping.items():
+            if self.reverse:
+                key = field.validate_item(key)
+                for obj in objs:
+                    obj = obj.pk if isinstance(obj, models.Model) else obj
+                    result.setdefault(obj, OrderedSet()).add(key)
+            else:
+                key = key.pk if isinstance(key, models.Model) else key
+                values = result.setdefault(key, OrderedSet())
+                values |= [field.validate_item(obj) for obj in objs]
+        return OrderedDict((key, list(values)) for key, values in result.items())
+
+    def _send_bulk_changed(self, action, pk_sets, using):
+        m2m_bulk_changed.send(
+            sender=self.through, action=action, reverse=self.reverse,
+            model=self.rel.model, pk_sets=pk_sets, using=using,
+        )
+
+    def _bulk_select_old(self, mapping, using):
+        """
+        Returns the current arrays of the rows in mapping, locking the rows until the
+        end of the transaction.
+        """
+        field = self.rel.field
+        opts = field.model._meta
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        sql = 'SELECT %s, %s FROM %s WHERE %s = ANY(%%s::%s[]) FOR UPDATE' % (
+            qn(opts.pk.column), qn(field.column), qn(opts.db_table), qn(opts.pk.column),
+            opts.pk.rel_db_type(connection))
+        pks = [opts.pk.get_db_prep_value(pk, connection) for pk in mapping]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [pks])
+            return dict((pk, old or []) for pk, old in cursor.fetchall())
+
+    def _bulk_execute(self, action, mapping, using):
+        """
+        Update the arrays of all the rows in mapping with a single
+        UPDATE ... FROM (VALUES ...) statement.
+        """
+        field = self.rel.field
+        opts = field.model._meta
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        names = {
+            'table': qn(opts.db_table),
+            'column': qn(field.column),
+            'pk': qn(opts.pk.column),
+        }
+        column_sql = '%(table)s.%(column)s' % names
+        # The intarray operators would sort the arrays, so the order preserving
+        # templates are used for all fields.
+        if action == 'add':
+            names['value'] = ArrayCatUnique.template % {'function': ArrayCatUnique.function, 'field': column_sql,
+                                                        'values': 'bulk.ids'}
+        elif action == 'remove':
+            names['value'] = ArrayRemoveMany.template % {'field': column_sql, 'values': 'bulk.ids'}
+        else:
+            names['value'] = 'bulk.ids'
+        row_sql = '(%%s::%s, %%s::%s)' % (opts.pk.rel_db_type(connection), field.db_type(connection))
+        names['rows'] = ', '.join([row_sql] * len(mapping))
+        params = []
+        for pk, values in mapping.items():
+            params.append(opts.pk.get_db_prep_value(pk, connection))
+            params.append(field.get_db_prep_value(values, connection))
+        sql = (
+            'UPDATE %(table)s SET %(column)s = %(value)s FROM (VALUES %(rows)s) AS bulk (pk, ids) '
+            'WHERE %(table)s.%(pk)s = bulk.pk'
+        ) % names
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _bulk_write(self, action, mapping, batch_size=None, using=None):
+        field = self.rel.field
+        using = using or router.db_for_write(field.model)
+        mapping = self._get_bulk_mapping(mapping)
+        if self.reverse and action == 'set':
+            raise ValueError("bulk_set() is only supported for forward array many to many relations.")
+        keys = list(mapping)
+        if not keys:
+            return
+        batch_size = batch_size or len(keys)
+        with transaction.atomic(using=using, savepoint=False):
+            for start in range(0, len(keys), batch_size):
+                batch = OrderedDict((key, mapping[key]) for key in keys[start:start + batch_size])
+                if action == 'set':
+                    old = self._bulk_select_old(batch, using)
+                    removed, added = OrderedDict(), OrderedDict()
+                    for pk, values in batch.items():
+                        old_values = OrderedSet(old.get(pk, ()))
+                        new_values = set(values)
+                        removed[pk] = [value for value in old_values if value not in new_values]
+                        added[pk] = [value for value in values if value not in old_values]
+                    changes = (
+                        ('remove', OrderedDict((pk, pks) for pk, pks in removed.items() if pks)),
+                        ('add', OrderedDict((pk, pks) for pk, pks in added.items() if pks)),
+                    )
+                    for change, pk_sets in changes:
+                        if pk_sets:
+                            self._send_bulk_changed('pre_%s' % change, pk_sets, using)
+                    self._bulk_execute(action, batch, using)
+                    for change, pk_sets in changes:
+                        if pk_sets:
+                            if self.rel.symmetrical:
+                                self._bulk_write_mirror(change, pk_sets, using)
+                            self._send_bulk_changed('post_%s' % change, pk_sets, using)
+                else:
+                    self._send_bulk_changed('pre_%s' % action, batch, using)
+                    self._bulk_execute(action, batch, using)
+                    if self.rel.symmetrical and not self.reverse:
+                        self._bulk_write_mirror(action, batch, using)
+                    self._send_bulk_changed('post_%s' % action, batch, using)
+
+    def _bulk_write_mirror(self, action, mapping, using):
+        # For symmetrical m2m relations to self, add or remove the mirror entries
+        mirror = OrderedDict()
+        for pk, values in mapping.items():
+            for value in values:
+                mirror.setdefault(value, []).append(pk)
+        self._bulk_execute(action, mirror, using)
+
+    def bulk_add(self, mapping, batch_size=None, using=None):
+        """
+        Add related objects to many instances at once. mapping is a dict of
+        {instance or pk: [related objects or pks]}. Each batch of batch_size
+        instances is written with one UPDATE statement.
+        """
+        self._bulk_write('add', mapping, batch_size=batch_size, using=using)
+
+    bulk_add.alters_data = True
+
+    def bulk_remove(self, mapping, batch_size=None, using=None):
+        """
+        Remove related objects from many instances at once. See bulk_add.
+        """
+        self._bulk_write('remove', mapping, batch_size=batch_size, using=using)
+
+    bulk_remove.alters_data = True
+
+    def bulk_set(self, mapping, batch_size=None, using=None):
+        """
+        Replace the related objects of many instances at once. Forward relations only.
+        See bulk_add.
+        """
+        self._bulk_write('set', mapping, batch_size=batch_size, using=using)
+
+    bulk_set.alters_data = True
+
+
+def _get_set_clear(kwargs):
+    """
+    Return the clear argument of set(), rejecting any other keyword arguments.
+    """
+    clear = kwargs.pop('clear', False)
+    if kwargs:
+        raise TypeError("set() got an unexpected keyword argument '%s'" % sorted(kwargs)[0])
+    return clear
+
 
 def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
     class ArrayForwardManyToManyManager(superclass):
@@ -77,6 +247,7 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
             self.to_field_name = self.target_field.name
             self.core_filters = {'%s' % self.rel.name: self.instance}
             self.symmetrical = self.rel.symmetrical
+            self.prefetch_strategy = self.field.prefetch_strategy
 
         def _apply_rel_filters(self, queryset):
             """
@@ -99,14 +270,37 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
             pks = []
             for instance in instances:
                 pks += getattr(instance, self.column)
-            filters = {'%s__in' % self.to_field_name: set(pks)}
+            filters = {'%s__any' % self.to_field_name: set(pks)}
             return filters
 
-        def validate_rel_obj(self, rel_obj, fks):
-            return getattr(rel_obj, self.to_field_name) in fks
+        def get_rel_obj_keys(self, rel_obj):
+            return getattr(rel_obj, self.to_field_name),
 
-        def get_instance_attr(self, instance):
-            return getattr(instance, self.column)
+        def get_instance_keys(self, instance):
+            return getattr(instance, self.column) or ()
+
+        def get_unnest_prefetch_queryset(self, instances, queryset):
+            """
+            Join the related table against the unnested arrays of the instances, so
+            each row carries the owner pk and its position in the owner's array and
+            ordering and grouping happen in the database.
+            """
+            connection = connections[queryset.db]
+            pk = self.related_model._meta.pk
+            parent_pks = [pk.get_db_prep_value(instance.pk, connection) for instance in instances]
+            queryset = queryset.all()
+            join = ArrayUnnestJoin('unnest_prefetch', queryset.query.get_initial_alias(), None, INNER, self.field,
+                                   False, parent_pks=parent_pks)
+            alias = queryset.query.join(join)
+            queryset = queryset.extra(select={
+                '_prefetch_related_val': '%s.parent_pk' % alias,
+                '_prefetch_related_position': '%s.position' % alias,
+            })
+            if not queryset.ordered:
+                queryset = queryset.extra(order_by=['%s.parent_pk' % alias, '%s.position' % alias])
+            return (queryset,
+                    lambda rel_obj: (rel_obj._prefetch_related_val,),
+                    lambda instance: (pk.get_db_prep_value(instance.pk, connection),))
 
         def get_prefetch_queryset(self, instances, queryset=None):
             if queryset is None:
@@ -115,11 +309,15 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
             queryset._add_hints(instance=instances[0])
             queryset = queryset.using(queryset._db or self._db)
 
-            query = self.get_prefetch_filters(instances)
-            queryset = queryset.filter(**query)
+            if self.prefetch_strategy == 'unnest':
+                queryset, rel_obj_keys, instance_keys = self.get_unnest_prefetch_queryset(instances, queryset)
+            else:
+                query = self.get_prefetch_filters(instances)
+                queryset = queryset.filter(**query)
+                rel_obj_keys, instance_keys = self.get_rel_obj_keys, self.get_instance_keys
             queryset.is_multi_reference = True
 
-            return queryset, self.validate_rel_obj, self.get_instance_attr, False, self.prefetch_cache_name, True
+            return queryset, rel_obj_keys, instance_keys, False, self.prefetch_cache_name, True
 
         def _update_instance(self, **kwargs):
             qs = self.related_model.objects.filter(pk=self.instance.pk)
@@ -127,72 +325,104 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
 
         _update_instance.alters_data = True
 
-        def _add_items(self, *objs):
+        def _add_items(self, *objs, **kwargs):
             objs = list(objs)
             if len(objs) == 1:
                 exclude = {self.column: objs[0]}
                 kwargs = {self.column: ArrayCat(self.column, objs, output_field=self.field)}
                 self.related_model.objects.filter(pk=self.instance.pk).exclude(**exclude).update(**kwargs)
             else:
-                instance = self.related_model.objects.only(self.column).get(pk=self.instance.pk)
-                objs = list(OrderedSet(objs) - set(getattr(instance, self.column)))
-                kwargs = {self.column: ArrayCat(self.column, objs, output_field=self.field)}
+                # Items already in the array are skipped by the database in the same
+                # UPDATE, so concurrent adds to the same row cannot duplicate entries.
+                kwargs = {self.column: ArrayCatUnique(self.column, objs, output_field=self.field)}
                 self._update_instance(**kwargs)
             # If this is a symmetrical m2m relation to self, add the mirror entry to the other objs array
             if self.symmetrical:
-                kwargs = {self.column: ArrayCat(self.column, [self.instance.pk], output_field=self.field)}
-                self.model.objects.filter(pk__in=objs).update(**kwargs)
+                self._add_mirror_items(*objs)
 
         _add_items.alters_data = True
 
+        def _add_mirror_items(self, *objs):
+            exclude = {self.column: self.instance.pk}
+            kwargs = {self.column: ArrayCat(self.column, [self.instance.pk], output_field=self.field)}
+            self.model.objects.filter(pk__any=objs).exclude(**exclude).update(**kwargs)
+
+        _add_mirror_items.alters_data = True
+
         def validate_item(self, obj):
             return self.field.validate_item(obj, model=self.model)
 
+        def _get_returning(self, kwargs):
+            returning = kwargs.get('returning', False)
+            if returning and not reverse:
+                raise TypeError('returning is only supported by the reverse side of %s.' % self.field)
+            return returning
+
         def add(self, *objs, **kwargs):
+            """
+            For reverse relations, returning=True returns the pks of the rows which
+            were actually changed. Forward relations change a single row, so they
+            don't accept it.
+            """
+            returning = self._get_returning(kwargs)
             objs = [self.validate_item(obj) for obj in objs]
             signals.m2m_changed.send(
                 sender=self.through, action='pre_add',
-                instance=self.instance, reverse=self.reverse,
+                instance=self.instance, reverse=reverse,
                 model=self.model, pk_set=objs, using=self.db,
             )
             with transaction.atomic():
-                self._add_items(*objs)
+                changed = self._add_items(*objs, returning=returning)
             signals.m2m_changed.send(
                 sender=self.through, action='post_add',
-                instance=self.instance, reverse=self.reverse,
+                instance=self.instance, reverse=reverse,
                 model=self.model, pk_set=objs, using=self.db,
             )
+            return changed
 
-        def remove(self, *objs):
+        def remove(self, *objs, **kwargs):
+            """
+            For reverse relations, returning=True returns the pks of the rows which
+            were actually changed. Forward relations change a single row, so they
+            don't accept it.
+            """
+            returning = self._get_returning(kwargs)
             objs = [self.validate_item(obj) for obj in objs]
             signals.m2m_changed.send(
                 sender=self.through, action="pre_remove",
-                instance=self.instance, reverse=self.reverse,
+                instance=self.instance, reverse=reverse,
                 model=self.model, pk_set=objs, using=self.db,
             )
             with transaction.atomic():
-                self._remove_items(*objs)
+                changed = self._remove_items(*objs, returning=returning)
             signals.m2m_changed.send(
                 sender=self.through, action="post_remove",
-                instance=self.instance, reverse=self.reverse,
+                instance=self.instance, reverse=reverse,
                 model=self.model, pk_set=objs, using=self.db,
             )
+            return changed
 
         remove.alters_data = True
 
         def _remove_items(self, *objs, **kwargs):
             if objs:
-                chunks = [objs[x:x + 100] for x in range(0, len(objs), 100)]
-                for chunk in chunks:
-                    kwargs = {self.column: multi_array_remove(self.column, *chunk)}
+                if len(objs) == 1:
+                    kwargs = {self.column: ArrayRemove(self.column, objs[0])}
+                else:
+                    kwargs = {self.column: ArrayRemoveMany(self.column, list(objs), output_field=self.field)}
                 self._update_instance(**kwargs)
-                # If this is a symmetrical m2m relation to self, add the mirror entry to the other objs array
+                # If this is a symmetrical m2m relation to self, remove the mirror entry from the other objs array
                 if self.symmetrical:
-                    kwargs = {self.column: ArrayRemove(self.column, self.instance.pk, output_field=self.field)}
-                    self.model.objects.filter(pk__in=list(objs)).update(**kwargs)
+                    self._remove_mirror_items(*objs)
 
         _remove_items.alters_data = True
 
+        def _remove_mirror_items(self, *objs):
+            kwargs = {self.column: ArrayRemove(self.column, self.instance.pk, output_field=self.field)}
+            self.model.objects.filter(pk__any=objs).update(**kwargs)
+
+        _remove_mirror_items.alters_data = True
+
         def create(self, **kwargs):
             new_obj = super(ArrayForwardManyToManyManager, self).create(**kwargs)
             self.add(new_obj)
@@ -221,11 +451,18 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
         update_or_create.alters_data = True
 
         def _clear(self):
+            """
+            Empty the array of the instance, returning the number of mirror rows
+            updated for symmetrical relations.
+            """
             kwargs = {self.column: []}
             self._update_instance(**kwargs)
             if self.symmetrical:
+                # Only touch the rows which contain the instance (GIN indexable @>)
+                filters = {self.column: self.instance.pk}
                 kwargs = {self.column: ArrayRemove(self.column, self.instance.pk, output_field=self.field)}
-                self.model.objects.update(**kwargs)
+                return self.model.objects.filter(**filters).update(**kwargs)
+            return 0
 
         _clear.alters_data = True
 
@@ -246,18 +483,61 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
 
         clear.alters_data = True
 
+        def _select_old(self):
+            """
+            Return the current array of the instance, locking its row until the end of
+            the transaction.
+            """
+            db = router.db_for_write(self.related_model, instance=self.instance)
+            connection = connections[db]
+            qn = connection.ops.quote_name
+            opts = self.related_model._meta
+            sql = 'SELECT %s FROM %s WHERE %s = %%s FOR UPDATE' % (
+                qn(self.field.column), qn(opts.db_table), qn(opts.pk.column))
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [opts.pk.get_db_prep_value(self.instance.pk, connection)])
+                row = cursor.fetchone()
+            return (row and row[0]) or []
+
         def set(self, objs, **kwargs):
+            """
+            Replace the related objects with objs in a single UPDATE. The row is read
+            and locked first so m2m_changed pre_remove and pre_add are sent with the
+            removed and added items before the array is written. With clear=True the
+            relation is cleared and objs added instead.
+            """
+            clear = _get_set_clear(kwargs)
+            objs = list(OrderedSet(self.validate_item(obj) for obj in objs))
             with transaction.atomic(savepoint=False):
-                old_ids = set(self.values_list(self.to_field_name, flat=True))
-                new_objs = []
-                for obj in objs:
-                    fk_val = (obj.pk if isinstance(obj, self.model) else obj)
-                    if fk_val in old_ids:
-                        old_ids.remove(fk_val)
-                    else:
-                        new_objs.append(obj)
-                self.remove(*old_ids)
-                self.add(*new_objs)
+                if clear:
+                    self.clear()
+                    self.add(*objs)
+                    return
+                old_ids = OrderedSet(self._select_old())
+                new_ids = set(objs)
+                changes = (
+                    ('remove', [obj for obj in old_ids if obj not in new_ids]),
+                    ('add', [obj for obj in objs if obj not in old_ids]),
+                )
+                changes = [(action, pk_set) for action, pk_set in changes if pk_set]
+                for action, pk_set in changes:
+                    signals.m2m_changed.send(
+                        sender=self.through, action='pre_' + action,
+                        instance=self.instance, reverse=reverse,
+                        model=self.model, pk_set=pk_set, using=self.db,
+                    )
+                self._update_instance(**{self.column: objs})
+                for action, pk_set in changes:
+                    if self.symmetrical:
+                        if action == 'remove':
+                            self._remove_mirror_items(*pk_set)
+                        else:
+                            self._add_mirror_items(*pk_set)
+                    signals.m2m_changed.send(
+                        sender=self.through, action='post_' + action,
+                        instance=self.instance, reverse=reverse,
+                        model=self.model, pk_set=pk_set, using=self.db,
+                    )
 
         set.alters_data = True
 
@@ -272,40 +552,98 @@ def create_array_many_to_many_manager(superclass, rel, reverse, IsJson):
             self.to_field_name = 'pk'
             self.to_field_value = self.instance.pk
             self.symmetrical = False
+            self.prefetch_strategy = 'in'
 
-        def validate_rel_obj(self, rel_obj, pk):
-            return pk in getattr(rel_obj, self.column)
+        def get_rel_obj_keys(self, rel_obj):
+            return getattr(rel_obj, self.column) or ()
 
-        def get_instance_attr(self, instance):
-            return getattr(instance, self.to_field_name)
+        def get_instance_keys(self, instance):
+            return getattr(instance, self.to_field_name),
 
         def get_prefetch_filters(self, instances):
             filters = {'%s__overlap' % self.fieldname: instances}
             return filters
 
+        def _update_rows(self, value_sql, contains, objs, returning=False):
+            """
+            Update the arrays of the rows in objs with a single UPDATE, binding the pks
+            as one array parameter. Only rows whose array contains (or, when contains is
+            False, doesn't contain) this instance are touched, which the database can
+            check with a GIN index. If returning is True the pks of the updated rows are
+            returned.
+            """
+            db = router.db_for_write(self.model, instance=self.instance)
+            connection = connections[db]
+            qn = connection.ops.quote_name
+            opts = self.model._meta
+            names = {
+                'table': qn(opts.db_table),
+                'column': qn(self.field.column),
+                'pk': qn(opts.pk.column),
+                'pk_type': opts.pk.rel_db_type(connection),
+                'db_type': self.field.db_type(connection),
+            }
+            names['value'] = value_sql % names
+            if contains:
+                condition = '%(column)s @> ARRAY[%%s]::%(db_type)s'
+            elif self.field.null:
+                condition = '(%(column)s IS NULL OR NOT %(column)s @> ARRAY[%%s]::%(db_type)s)'
+            else:
+                condition = 'NOT %(column)s @> ARRAY[%%s]::%(db_type)s'
+            sql = 'UPDATE %(table)s SET %(column)s = %(value)s WHERE %(pk)s = ANY(%%s::%(pk_type)s[]) AND ' + condition
+            if returning:
+                sql += ' RETURNING %(pk)s'
+            value = self.field.base_field.get_db_prep_value(self.to_field_value, connection)
+            params = [value, [opts.pk.get_db_prep_value(obj, connection) for obj in objs], value]
+            with connection.cursor() as cursor:
+                cursor.execute(sql % names, params)
+                if returning:
+                    return [row[0] for row in cursor.fetchall()]
+            return None
+
+        _update_rows.alters_data = True
+
         def _add_items(self, *objs, **kwargs):
-            exclude = {self.column: self.instance.pk}
-            qs = self.model.objects.filter(pk__in=objs).exclude(**exclude)
-            kwargs = {self.column: ArrayCat(self.column, [self.to_field_value])}
-            qs.update(**kwargs)
+            return self._update_rows('ARRAY_APPEND(%(column)s, %%s)', False, objs, **kwargs)
 
         _add_items.alters_data = True
 
         def _remove_items(self, *objs, **kwargs):
-            qs = self.filter(pk__in=objs)
-            kwargs = {self.column: ArrayRemove(self.column, self.to_field_value)}
-            with transaction.atomic():
-                qs.update(**kwargs)
+            return self._update_rows('ARRAY_REMOVE(%(column)s, %%s)', True, objs, **kwargs)
 
         _remove_items.alters_data = True
 
         def _clear(self):
-            with transaction.atomic():
-                kwargs = {self.column: ArrayRemove(self.column, self.to_field_value)}
-            self.model.objects.update(**kwargs)
+            """
+            Remove the instance from the arrays which contain it (GIN indexable @>),
+            returning the number of rows updated.
+            """
+            filters = {self.column: self.to_field_value}
+            kwargs = {self.column: ArrayRemove(self.column, self.to_field_value)}
+            return self.model.objects.filter(**filters).update(**kwargs)
 
         _clear.alters_data = True
 
+        def set(self, objs, **kwargs):
+            clear = _get_set_clear(kwargs)
+            with transaction.atomic(savepoint=False):
+                if clear:
+                    self.clear()
+                    self.add(*objs)
+                    return
+                old_ids = set(self.values_list(self.to_field_name, flat=True))
+                new_objs = []
+                for obj in objs:
+                    fk_val = (obj.pk if isinstance(obj, self.model) else obj)
+                    if fk_val in old_ids:
+                        old_ids.remove(fk_val)
+                    else:
+                        new_objs.append(obj)
+                self.remove(*old_ids)
+                self.add(*new_objs)
+
+        set.alters_data = True
+
     if reverse:
         return ArrayReverseManyToManyManager
     return ArrayForwardManyToManyManager
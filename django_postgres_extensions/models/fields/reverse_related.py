@@ -26,11 +26,19 @@ class ArrayManyToManyRel(ForeignObjectRel):
         self.symmetrical = symmetrical
 
     def get_join_on(self, parent_alias, lhs_col, table_alias, rhs_col):
-        return '%s.%s = ANY(%s.%s)' % (
-            parent_alias,
-            lhs_col,
+        if self.field.join_strategy == 'any':
+            return '%s.%s = ANY(%s.%s)' % (
+                parent_alias,
+                lhs_col,
+                table_alias,
+                rhs_col,
+            )
+        # The containment check can use the GIN index on the array column.
+        return '%s.%s @> ARRAY[%s.%s]' % (
             table_alias,
             rhs_col,
+            parent_alias,
+            lhs_col,
         )
 
     def set_field_name(self):
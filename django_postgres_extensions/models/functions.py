@@ -1,15 +1,20 @@
-from django.db.models.expressions import Func, Expression
-from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+import csv
+import itertools
+import re
+
+from django.db.models.expressions import F as BaseF, Func, Expression
 from django.utils import six
+from psycopg2.extras import Json
 
-from .expressions import F, Value as V
+from .expressions import F, Increment, Value as V, json_parents_sql
 
 
 class SimpleFunc(Func):
 
     def __init__(self, field, *values, **extra):
         if not isinstance(field, Expression):
-            field = F(field)
+            if not isinstance(field, BaseF):
+                field = F(field)
             if values and not isinstance(values[0], Expression):
                 values = [V(v) for v in values]
         super(SimpleFunc, self).__init__(field, *values, **extra)
@@ -19,22 +24,58 @@ class TooManyExpressionsError(Exception):
     pass
 
 
+class MultiFunc(Func):
+    """
+    Applies func to expression once for each of args, compiling to
+    func(...func(func(expression, arg1), arg2)..., argN). The calls are a single
+    expression node whose SQL is built in one pass, so there's no limit on the number
+    of args. An arg which is a tuple gives several arguments to one call, e.g. the
+    search and replacement values of ARRAY_REPLACE.
+    """
+
+    def __init__(self, func, expression, args, **extra):
+        if not isinstance(expression, (Expression, BaseF)):
+            expression = F(expression)
+        self.function = func.function
+        self.arities = []
+        values = []
+        for arg in args:
+            arg = arg if isinstance(arg, tuple) else (arg,)
+            self.arities.append(len(arg))
+            values.extend(value if isinstance(value, Expression) else V(value) for value in arg)
+        super(MultiFunc, self).__init__(expression, *values, **extra)
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        params = list(params)
+        sql_parts = ['%s(' % self.function * len(self.arities), sql]
+        values = iter(self.source_expressions[1:])
+        for arity in self.arities:
+            arg_sqls = []
+            for value in itertools.islice(values, arity):
+                arg_sql, arg_params = compiler.compile(value)
+                arg_sqls.append(arg_sql)
+                params.extend(arg_params)
+            sql_parts.append(', %s)' % ', '.join(arg_sqls))
+        return ''.join(sql_parts), params
+
+
 def multi_func(func, expression, *args):
-    if len(args) > GET_ITERATOR_CHUNK_SIZE:
-        raise TooManyExpressionsError('Multi-func given %s args. The limit is %s due to Python recursion depth risk' % (
-            len(args), GET_ITERATOR_CHUNK_SIZE))
-    args = list(args)
-    initial_arg = args.pop(0)
-    query = func(expression, initial_arg)
-    for arg in args:
-        query = func(query, arg)
-    return query
+    return MultiFunc(func, expression, args)
 
 
 def multi_array_remove(field, *args):
     return multi_func(ArrayRemove, field, *args)
 
 
+def multi_array_replace(field, *pairs):
+    return multi_func(ArrayReplace, field, *[tuple(pair) for pair in pairs])
+
+
+def multi_array_append(field, *args):
+    return multi_func(ArrayAppend, field, *args)
+
+
 class ArrayAppend(SimpleFunc):
     function = 'ARRAY_APPEND'
 
@@ -71,6 +112,10 @@ class ArrayCat(Func):
     def __init__(self, field, value, prepend=False, output_field=None, **extra):
         if not isinstance(field, Expression):
             field = F(field)
+        if value is None:
+            # Subclasses which only operate on the field
+            super(ArrayCat, self).__init__(field, output_field=output_field, **extra)
+            return
         if not isinstance(value, Expression):
             if isinstance(value, six.string_types):
                 value = F(value)
@@ -84,6 +129,132 @@ class ArrayCat(Func):
             super(ArrayCat, self).__init__(field, value, **extra)
 
 
+class ArraySubqueryFunc(ArrayCat):
+    """
+    Base class for array functions built from an UNNEST subquery over the field
+    and an array of values. The template may reference %(field)s and %(values)s
+    any number of times; params are repeated to match. intarray_template is used
+    instead for fields which use the intarray extension.
+    """
+    template = None
+    intarray_template = None
+
+    def __init__(self, field, value, output_field=None, **extra):
+        super(ArraySubqueryFunc, self).__init__(field, value, output_field=output_field, **extra)
+
+    def uses_intarray(self, connection):
+        field = self.source_expressions[0]._output_field_or_none
+        return bool(getattr(field, 'uses_intarray', None) and field.uses_intarray(connection))
+
+    def as_sql(self, compiler, connection, function=None, template=None):
+        if template is None and self.intarray_template and self.uses_intarray(connection):
+            template = self.intarray_template
+        template = template or self.template
+        compiled = dict((name, compiler.compile(expression))
+                        for name, expression in zip(('field', 'values'), self.source_expressions))
+        sql = template % dict([('function', function or self.function)] +
+                              [(name, value[0]) for name, value in six.iteritems(compiled)])
+        params = []
+        for name in re.findall(r'%\((field|values)\)s', template):
+            params.extend(compiled[name][1])
+        return sql, params
+
+
+class ArrayCatUnique(ArraySubqueryFunc):
+    """
+    Appends the values which are not already in the array, in order and ignoring
+    duplicates within the values. The comparison happens in the database so the
+    existing array is never sent to the client.
+    """
+    template = (
+        '%(function)s(%(field)s, ARRAY(SELECT appended.value FROM UNNEST(%(values)s) '
+        'WITH ORDINALITY AS appended (value, position) WHERE NOT EXISTS (SELECT 1 FROM UNNEST(%(field)s) '
+        'AS existing (value) WHERE existing.value = appended.value) '
+        'GROUP BY appended.value ORDER BY MIN(appended.position)))'
+    )
+
+
+class ArrayRemoveMany(ArraySubqueryFunc):
+    """
+    Removes every occurrence of each of the values from the array, keeping the
+    order of the remaining elements. Unlike nested ARRAY_REMOVE calls the SQL
+    is the same size however many values are given.
+    """
+    template = (
+        'ARRAY(SELECT existing.value FROM UNNEST(%(field)s) WITH ORDINALITY AS existing (value, position) '
+        'WHERE NOT EXISTS (SELECT 1 FROM UNNEST(%(values)s) AS removed (value) '
+        'WHERE removed.value = existing.value) ORDER BY existing.position)'
+    )
+
+
+class ArraySetFunc(ArraySubqueryFunc):
+    """
+    Base class for set operations on arrays. The result holds each element once, in
+    the order it first appears in the field (then the values). With sort=True the
+    elements are sorted instead, using the intarray operators for integer arrays when
+    that extension is installed in the database. Fields which use intarray always
+    get the sorted result of its operators.
+    """
+    element_source = '%(field)s'
+    element_filter = ''
+
+    def __init__(self, field, value, output_field=None, sort=False, **extra):
+        self.sort = sort
+        super(ArraySetFunc, self).__init__(field, value, output_field=output_field, **extra)
+
+    def uses_intarray(self, connection):
+        field = self.source_expressions[0]._output_field_or_none
+        if self.sort and field is not None and field.db_type(connection) == 'integer[]':
+            return 'intarray' in getattr(connection, 'installed_extensions', ())
+        return super(ArraySetFunc, self).uses_intarray(connection)
+
+    def as_sql(self, compiler, connection, function=None, template=None):
+        if template is None and not (self.intarray_template and self.uses_intarray(connection)):
+            template = (
+                'ARRAY(SELECT element.value FROM UNNEST(%s) WITH ORDINALITY AS element (value, position)%s '
+                'GROUP BY element.value ORDER BY %s)' % (
+                    self.element_source, self.element_filter,
+                    'element.value' if self.sort else 'MIN(element.position)'))
+        return super(ArraySetFunc, self).as_sql(compiler, connection, function=function, template=template)
+
+
+class ArrayUnion(ArraySetFunc):
+    """
+    The distinct elements of the array field followed by those of the values which
+    are not already in it.
+    """
+    element_source = 'ARRAY_CAT(%(field)s, %(values)s)'
+    intarray_template = "(COALESCE(%(field)s, '{}') | %(values)s)"
+
+
+class ArrayIntersect(ArraySetFunc):
+    """
+    The distinct elements of the array field which are also in the values.
+    """
+    element_filter = (' WHERE EXISTS (SELECT 1 FROM UNNEST(%(values)s) AS other (value) '
+                      'WHERE other.value = element.value)')
+    intarray_template = "(COALESCE(%(field)s, '{}') & %(values)s)"
+
+
+class ArrayDifference(ArraySetFunc):
+    """
+    The distinct elements of the array field which are not in the values.
+    """
+    element_filter = (' WHERE NOT EXISTS (SELECT 1 FROM UNNEST(%(values)s) AS other (value) '
+                      'WHERE other.value = element.value)')
+    intarray_template = "(COALESCE(%(field)s, '{}') - %(values)s)"
+
+
+class ArrayDistinct(ArraySetFunc):
+    """
+    The distinct elements of the array field.
+    """
+    intarray_template = "UNIQ(SORT(COALESCE(%(field)s, '{}')))"
+
+    def __init__(self, field, sort=False, **extra):
+        super(ArrayDistinct, self).__init__(field, None, sort=sort, **extra)
+
+
 class ArrayLength(SimpleFunc):
     function = 'ARRAY_LENGTH'
 
@@ -117,6 +288,75 @@ class HStore(NonFieldFunc):
     function = 'HSTORE'
 
 
+class HStorePatch(Func):
+    """
+    Sets and deletes many hstore keys in one expression,
+    (field - delete_keys) || hstore(keys, values). patch is a dictionary in which a
+    value of None deletes the key. Keys and values are sent as text arrays, so values
+    should be strings. In updates run inside a transaction, patches with more than
+    stream_threshold keys are streamed into a temporary table with COPY just before
+    the update is executed, and applied from there.
+    """
+    stream_threshold = 10000
+    temp_table_ids = itertools.count()
+
+    def __init__(self, field, patch, **extra):
+        if not isinstance(field, Expression):
+            field = F(field)
+        self.keys, self.values, self.deleted = [], [], []
+        for key, value in six.iteritems(patch):
+            if value is None:
+                self.deleted.append(key)
+            else:
+                self.keys.append(key)
+                self.values.append(value)
+        self.stream_table = 'hstore_patch_%s' % next(self.temp_table_ids)
+        super(HStorePatch, self).__init__(field, **extra)
+
+    def stream(self, connection):
+        """
+        Copies the patch into a temporary table dropped at the end of the
+        transaction.
+        """
+        table = connection.ops.quote_name(self.stream_table)
+        data = six.StringIO()
+        writer = csv.writer(data, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerows(six.moves.zip(self.keys, self.values, itertools.repeat('f')))
+        writer.writerows(six.moves.zip(self.deleted, itertools.repeat(''), itertools.repeat('t')))
+        data.seek(0)
+        with connection.cursor() as cursor:
+            # The same update may be executed more than once in a transaction
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+            cursor.execute('CREATE TEMPORARY TABLE %s (key text NOT NULL, value text, deleted boolean NOT NULL) '
+                           'ON COMMIT DROP' % table)
+            cursor.copy_expert('COPY %s (key, value, deleted) FROM STDIN WITH (FORMAT csv)' % table, data)
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        sql = "COALESCE(%s, ''::hstore)" % sql
+        # Compiling has no side effects: the patch is only streamed when an update
+        # compiler executes the SQL.
+        pre_execute_hooks = getattr(compiler, 'pre_execute_hooks', None)
+        if (pre_execute_hooks is not None and len(self.keys) + len(self.deleted) > self.stream_threshold and
+                connection.in_atomic_block):
+            pre_execute_hooks[self.stream_table] = self.stream
+            table = connection.ops.quote_name(self.stream_table)
+            if self.deleted:
+                sql = '(%s - ARRAY(SELECT key FROM %s WHERE deleted))' % (sql, table)
+            if self.keys:
+                sql = '%s || (SELECT hstore(array_agg(key), array_agg(value)) FROM %s WHERE NOT deleted)' % (
+                    sql, table)
+            return sql, params
+        params = list(params)
+        if self.deleted:
+            sql = '(%s - %%s::text[])' % sql
+            params.append(self.deleted)
+        if self.keys:
+            sql = '%s || hstore(%%s::text[], %%s::text[])' % sql
+            params.extend([self.keys, self.values])
+        return sql, params
+
+
 class AKeys(SimpleFunc):
     function = 'AKEYS'
 
@@ -193,6 +433,86 @@ class JSONBSet(SimpleFunc):
     function = 'JSONB_SET'
 
 
+class JSONBPathFunc(Func):
+    """
+    Base class for updates of the value at a path in a jsonb document built on
+    JSONB_SET, so only the path and the new value are sent to the database. A NULL
+    document is treated as {}, and objects missing along the path are created. The
+    template may reference %(document)s (the document with the parents of the path),
+    %(field)s (the original document), %(path)s and %(value)s any number of times;
+    params are repeated to match.
+    """
+    template = None
+
+    def __init__(self, field, path, value, **extra):
+        if not isinstance(field, (Expression, BaseF)):
+            field = F(field)
+        if isinstance(path, six.string_types):
+            path = path.split('__')
+        self.path = None if isinstance(path, Expression) else [six.text_type(key) for key in path]
+        if not isinstance(path, Expression):
+            path = V(self.path)
+        if not isinstance(value, Expression):
+            value = V(self.prepare_value(value))
+        super(JSONBPathFunc, self).__init__(field, path, value, **extra)
+
+    def prepare_value(self, value):
+        return value
+
+    def as_sql(self, compiler, connection):
+        field_sql, field_params = compiler.compile(self.source_expressions[0])
+        compiled = {
+            'field': ('path_doc.doc', []),
+            'document': json_parents_sql('path_doc.doc', 'path_doc.doc', [self.path] if self.path else []),
+            'path': compiler.compile(self.source_expressions[1]),
+            'value': compiler.compile(self.source_expressions[2]),
+        }
+        sql = self.template % dict((name, compiled[name][0]) for name in compiled)
+        params = []
+        for name in re.findall(r'%\((document|field|path|value)\)s', self.template):
+            params.extend(compiled[name][1])
+        sql = "(SELECT %s FROM (SELECT COALESCE(%s, '{}'::jsonb) AS doc) AS path_doc)" % (sql, field_sql)
+        return sql, params + list(field_params)
+
+
+class JSONBSetPath(JSONBPathFunc):
+    """
+    Sets the value at path, creating it (and any missing parent objects) if it's
+    missing.
+    """
+    template = 'JSONB_SET(%(document)s, %(path)s, %(value)s::jsonb)'
+
+    def prepare_value(self, value):
+        return Json(value)
+
+
+class JSONBIncrement(Increment):
+    """
+    Adds value to the number at path, treating a missing value (or document) as
+    default. The same as F(field).increment(path, value, default).
+    """
+
+    def __init__(self, field, path, value, default=0, **extra):
+        if not isinstance(field, (Expression, BaseF)):
+            field = F(field)
+        if isinstance(path, (list, tuple)):
+            path = tuple(path)
+        super(JSONBIncrement, self).__init__(field, {path: value}, default=default, **extra)
+
+
+class JSONBAppend(JSONBPathFunc):
+    """
+    Appends value to the array at path, creating the array if it's missing. A list
+    value appends each of its items.
+    """
+    template = "JSONB_SET(%(document)s, %(path)s, COALESCE(%(field)s #> %(path)s, '[]'::jsonb) || %(value)s::jsonb)"
+
+    def prepare_value(self, value):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return Json(value)
+
+
 class JSONBArrayLength(SimpleFunc):
     function = 'JSONB_ARRAY_length'
 
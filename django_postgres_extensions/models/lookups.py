@@ -1,5 +1,7 @@
 from django.contrib.postgres.fields.array import ArrayField, ArrayContains
-from django.db.models.lookups import BuiltinLookup, Contains, StartsWith, EndsWith
+from django.db.models import Field, Model
+from django.db.models.lookups import BuiltinLookup, Contains, StartsWith, EndsWith, Lookup
+from django.utils import six
 
 
 class BaseAnyAllLookupMixin(object):
@@ -14,10 +16,21 @@ class BaseAnyAllLookupMixin(object):
     def as_sql(self, compiler, connection):
         rhs_sql, rhs_params = self.process_lhs(compiler, connection)
         lhs_sql, params = self.process_rhs(compiler, connection)
+        if self.is_indexable():
+            db_type = self.lhs.output_field.db_type(connection)
+            return '%s @> ARRAY[%s]::%s' % (rhs_sql, lhs_sql, db_type), list(rhs_params) + list(params)
         params.extend(rhs_params)
         rhs_sql = self.get_rhs_op(connection, rhs_sql)
         return '%s %s' % (lhs_sql, rhs_sql), params
 
+    def is_indexable(self):
+        """
+        value = ANY(field) with a literal value is the same as field @> ARRAY[value],
+        which can use a GIN index on the field.
+        """
+        return (self.db_func == 'any' and self.lookup_name in ('any', 'any_exact') and self.rhs_is_direct_value() and
+                self.rhs is not None and not isinstance(self.rhs, (list, tuple)))
+
 
 class AnyLookupMixin(BaseAnyAllLookupMixin, BuiltinLookup):
     db_func = 'any'
@@ -134,3 +147,39 @@ class ContainsItem(ArrayContains):
         if not isinstance(rhs, (list, tuple)):
             rhs = [rhs]
         super(ContainsItem, self).__init__(lhs, rhs)
+
+
+@Field.register_lookup
+class EqualsAny(Lookup):
+    """
+    Like __in, but binds the values as a single array parameter (field = ANY(%s::type[]))
+    so the SQL doesn't grow with the number of values.
+    """
+    lookup_name = 'any'
+
+    def get_prep_lookup(self):
+        if hasattr(self.rhs, 'resolve_expression'):
+            return self.rhs
+        rhs = self.rhs
+        if isinstance(rhs, six.string_types) or not hasattr(rhs, '__iter__'):
+            rhs = [rhs]
+        values = []
+        for value in rhs:
+            if isinstance(value, Model):
+                value = value.pk
+            if value is not None:
+                values.append(self.lhs.output_field.get_prep_value(value))
+        return values
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, params = self.process_lhs(compiler, connection)
+        if hasattr(self.rhs, 'as_sql'):
+            if not getattr(self.rhs, 'has_select_fields', True):
+                # A queryset selects its primary keys, as with __in
+                self.rhs.clear_select_clause()
+                self.rhs.add_fields(['pk'])
+            rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+            return '%s = ANY(ARRAY%s)' % (lhs_sql, rhs_sql), params + list(rhs_params)
+        field = self.lhs.output_field
+        values = [field.get_db_prep_value(value, connection, prepared=True) for value in self.rhs]
+        return '%s = ANY(%%s::%s[])' % (lhs_sql, field.rel_db_type(connection)), params + [values]
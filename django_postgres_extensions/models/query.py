@@ -1,7 +1,8 @@
 import copy
+from collections import OrderedDict
 
 from django.core import exceptions
-from django.db import transaction
+from django.db import connections, transaction
 from django.db.models.constants import LOOKUP_SEP
 from django.db.models.sql.constants import CURSOR
 
@@ -27,6 +28,31 @@ def update(self, **kwargs):
 update.alters_data = True
 
 
+def update_returning(self, fields, **kwargs):
+    """
+    Updates all elements in the current QuerySet like update(), returning an
+    iterator over tuples of the new values of fields, a list of field names, for
+    the updated rows instead of the number of rows.
+    """
+    assert self.query.can_filter(), \
+        "Cannot update a query once a slice has been taken."
+    self._for_write = True
+    query = self.query.chain(UpdateQuery)
+    query.add_update_values(kwargs)
+    query.add_returning_fields(fields)
+    with transaction.atomic(using=self.db, savepoint=False):
+        rows = query.get_compiler(self.db).execute_returning()
+    self._result_cache = None
+    return rows
+
+
+update_returning.alters_data = True
+
+
+def manager_update_returning(self, *args, **kwargs):
+    return self.get_queryset().update_returning(*args, **kwargs)
+
+
 def _update(self, values):
     """
     A version of update that accepts field objects instead of field names.
@@ -47,6 +73,51 @@ _update.alters_data = True
 _update.queryset_only = False
 
 
+def bulk_update_values(self, rows, batch_size=None):
+    """
+    Writes different values to different rows. rows is an iterable of
+    (pk, {lookup: value}) pairs using the same lookups as update(), e.g.
+    (1, {'scores__3': 10}). Rows which produce the same SET clause are written with
+    one UPDATE ... FROM (VALUES ...) statement per batch of batch_size rows.
+    Returns the number of rows updated. A pk may only be given once for the same
+    lookups, as Postgres would apply just one of the rows.
+    """
+    assert self.query.can_filter(), \
+        "Cannot update a query once a slice has been taken."
+    self._for_write = True
+    query = self.query.chain(UpdateQuery)
+    compiler = query.get_compiler(self.db)
+    pk_field = query.get_meta().pk
+    groups, group_pks = OrderedDict(), {}
+    for pk, values in rows:
+        set_sqls, params = compiler.compile_bulk_row(values)
+        pks = group_pks.setdefault(set_sqls, set())
+        prep_pk = pk_field.get_prep_value(pk)
+        if prep_pk in pks:
+            raise ValueError("bulk_update_values() got the pk %r more than once for the same lookups." % pk)
+        pks.add(prep_pk)
+        groups.setdefault(set_sqls, []).append((pk, params))
+    compiler.pre_sql_setup()
+    updated = 0
+    with transaction.atomic(using=self.db, savepoint=False):
+        compiler.pre_execute()
+        with connections[self.db].cursor() as cursor:
+            for set_sqls, group in groups.items():
+                size = batch_size or len(group)
+                for start in range(0, len(group), size):
+                    cursor.execute(*compiler.bulk_as_sql(set_sqls, group[start:start + size]))
+                    updated += cursor.rowcount
+    self._result_cache = None
+    return updated
+
+
+bulk_update_values.alters_data = True
+
+
+def manager_bulk_update_values(self, *args, **kwargs):
+    return self.get_queryset().bulk_update_values(*args, **kwargs)
+
+
 def format(self, field, expression, output_field=None, *args, **kwargs):
     if not output_field:
         output_field = field + '__alt'
@@ -101,8 +172,20 @@ def prefetch_one_level(instances, prefetcher, lookup, level):
     is_multi_reference = getattr(rel_qs, 'is_multi_reference', False)
 
     rel_obj_cache = {}
-    if not is_multi_reference:
-        rel_obj_cache = {}
+    rel_obj_positions = {}
+    if is_multi_reference:
+        # For multi reference querysets rel_obj_attr returns every key a related
+        # object should be found under, giving an inverted index so that each
+        # instance is matched in O(len(keys)) rather than scanning all objects.
+        # Results follow the order of the instance's keys (i.e. the array order)
+        # unless the related queryset is ordered, in which case that order wins.
+        ordered = rel_qs.ordered
+        for position, rel_obj in enumerate(all_related_objects):
+            for rel_attr_val in rel_obj_attr(rel_obj):
+                rel_obj_cache.setdefault(rel_attr_val, []).append(rel_obj)
+            if ordered:
+                rel_obj_positions[id(rel_obj)] = position
+    else:
         for rel_obj in all_related_objects:
             rel_attr_val = rel_obj_attr(rel_obj)
             rel_obj_cache.setdefault(rel_attr_val, []).append(rel_obj)
@@ -125,10 +208,19 @@ def prefetch_one_level(instances, prefetcher, lookup, level):
     leaf = len(lookup.prefetch_through.split(LOOKUP_SEP)) - 1 == level
 
     for obj in instances:
-        instance_attr_val = instance_attr(obj)
         if is_multi_reference:
-            vals = [rel_obj for rel_obj in all_related_objects if rel_obj_attr(rel_obj, instance_attr_val)]
+            # An array may hold the same key more than once, but each related object
+            # is only returned once, as with an IN filter.
+            vals, seen = [], set()
+            for instance_attr_val in instance_attr(obj):
+                for rel_obj in rel_obj_cache.get(instance_attr_val, ()):
+                    if rel_obj.pk not in seen:
+                        seen.add(rel_obj.pk)
+                        vals.append(rel_obj)
+            if rel_obj_positions and len(vals) > 1:
+                vals.sort(key=lambda rel_obj: rel_obj_positions[id(rel_obj)])
         else:
+            instance_attr_val = instance_attr(obj)
             vals = rel_obj_cache.get(instance_attr_val, [])
 
         if single:
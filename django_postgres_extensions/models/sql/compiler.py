@@ -1,63 +1,264 @@
-from django.core.exceptions import FieldError
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import chain
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet, FieldError
+from django.db.models.expressions import Col
+from django.db.models.lookups import BuiltinLookup, In
 from django.db.models.sql.compiler import (SQLCompiler, SQLInsertCompiler, SQLUpdateCompiler as BaseUpdateCompiler,
-                                           SQLAggregateCompiler, SQLDeleteCompiler)
+                                           SQLAggregateCompiler, SQLDeleteCompiler, cursor_iter)
+from django.db.models.sql.constants import CURSOR, GET_ITERATOR_CHUNK_SIZE
+from django.db.models.sql.where import WhereNode
+from psycopg2.extras import Json
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
 
 
 def no_quote_name(name):
     return name
 
 
+class SQLCache(object):
+    """
+    A thread safe LRU cache of SQL strings. The size is read from the
+    UPDATE_SQL_CACHE_SIZE setting unless maxsize is given; a size of 0 disables
+    the cache.
+    """
+    default_maxsize = 128
+
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, 'UPDATE_SQL_CACHE_SIZE', self.default_maxsize)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                sql = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._cache[key] = sql
+            self.hits += 1
+            return sql
+
+    def set(self, key, sql):
+        maxsize = self.maxsize
+        with self._lock:
+            self._cache.pop(key, None)
+            while self._cache and len(self._cache) >= maxsize:
+                self._cache.popitem(last=False)
+            if maxsize > 0:
+                self._cache[key] = sql
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
+update_sql_cache = SQLCache()
+
+
 class SQLUpdateCompiler(BaseUpdateCompiler):
+    def __init__(self, *args, **kwargs):
+        super(SQLUpdateCompiler, self).__init__(*args, **kwargs)
+        # Callables taking the connection, registered by expressions as they're
+        # compiled and called just before the statement is executed.
+        self.pre_execute_hooks = OrderedDict()
+        self.executing = False
+
+    def pre_execute(self):
+        hooks, self.pre_execute_hooks = self.pre_execute_hooks, OrderedDict()
+        for hook in hooks.values():
+            hook(self.connection)
+
+    def execute_sql(self, result_type):
+        self.executing = True
+        try:
+            return super(SQLUpdateCompiler, self).execute_sql(result_type)
+        finally:
+            self.executing = False
+
+    def get_where_cache_key(self, node, params):
+        """
+        Returns a key for the structure of the where node, appending its parameters
+        to params, or None if the SQL of the node can depend on more than its
+        structure.
+        """
+        if isinstance(node, WhereNode):
+            children = []
+            for child in node.children:
+                child_key = self.get_where_cache_key(child, params)
+                if child_key is None:
+                    return None
+                children.append(child_key)
+            return node.connector, node.negated, tuple(children)
+        lookup_class = type(node)
+        if not (isinstance(node, BuiltinLookup) and lookup_class.as_sql in (BuiltinLookup.as_sql, In.as_sql)):
+            return None
+        if not isinstance(node.lhs, Col) or not node.rhs_is_direct_value():
+            return None
+        try:
+            rhs_sql, rhs_params = node.process_rhs(self, self.connection)
+        except EmptyResultSet:
+            return None
+        params.extend(rhs_params)
+        return lookup_class, node.lhs.alias, node.lhs.target, node.lhs.output_field, rhs_sql
+
+    def get_cache_key(self):
+        """
+        Returns a key for the structural shape of the update query and the
+        parameters to bind to the cached SQL, or (None, None) if the query can't be
+        cached, e.g. because it updates or filters with expressions.
+        """
+        update_params, values = [], []
+        for field, model, val in self.query.values:
+            name = field.column
+            altered = hasattr(val, 'alter_name')
+            if altered:
+                name = val.alter_name(name, no_quote_name)
+                val = val.value
+            if hasattr(val, 'resolve_expression') or hasattr(val, 'prepare_database_save'):
+                return None, None
+            val = field.get_db_prep_save(val, connection=self.connection)
+            if hasattr(val, 'as_sql'):
+                return None, None
+            if val is not None:
+                update_params.append(val)
+            values.append((field, name, altered, val is None))
+        where_params = []
+        where = self.get_where_cache_key(self.query.where, where_params)
+        if where is None:
+            return None, None
+        key = (self.connection.alias, self.query.base_table, tuple(values), where)
+        return key, tuple(update_params + where_params)
+
     def as_sql(self):
         """
         Creates the SQL for this query. Returns the SQL string and list of
-        parameters.
+        parameters. The SQL of queries with the same shape is cached, so repeated
+        updates only need their parameters bound again.
         """
         self.pre_sql_setup()
         if not self.query.values:
             return '', ()
+        key, params = self.get_cache_key() if update_sql_cache.maxsize else (None, None)
+        if key is not None:
+            sql = update_sql_cache.get(key)
+            if sql is not None:
+                return self.add_returning(sql), params
+        sql, params = self.compile_update()
+        if key is not None and sql:
+            update_sql_cache.set(key, sql)
+        if self.executing:
+            self.pre_execute()
+        return self.add_returning(sql), params
+
+    def get_returning_cols(self):
+        return [field.get_col(self.query.base_table) for field in self.query.returning]
+
+    def add_returning(self, sql):
+        if sql and self.query.returning:
+            sql += ' RETURNING %s' % ', '.join(self.compile(col)[0] for col in self.get_returning_cols())
+        return sql
+
+    def execute_returning(self, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        """
+        Executes the update and returns an iterator over the rows of the query's
+        returning fields, which are converted by the fields as they're consumed.
+        """
+        try:
+            sql, params = self.as_sql()
+            if not sql:
+                raise EmptyResultSet
+        except EmptyResultSet:
+            return iter([])
+        self.pre_execute()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+        except Exception:
+            cursor.close()
+            raise
+        for query in self.query.get_related_updates():
+            query.get_compiler(self.using).execute_sql(CURSOR)
+        rows = chain.from_iterable(cursor_iter(cursor, self.connection.features.empty_fetchmany_value, None,
+                                               chunk_size))
+        converters = self.get_converters(self.get_returning_cols())
+        if converters:
+            rows = self.apply_converters(rows, converters)
+        return (tuple(row) for row in rows)
+
+    def compile_update_value(self, field, val, qn, cast=False):
+        """
+        Returns the SET clause for a single value as (sql, params, qn), qn being the
+        quoting function for the names which follow. If cast is True, placeholders for
+        plain values are cast to the type of the column (or array element) they're
+        written to.
+        """
+        self.name = name = field.column
+        cast_field = field
+        if hasattr(val, 'alter_name'):
+            self.name = name = val.alter_name(name, qn)
+            qn = no_quote_name
+            if not val.is_slice:
+                for index in val.indexes:
+                    cast_field = getattr(cast_field, 'base_field', cast_field)
+            val = val.value
+        if hasattr(val, 'resolve_expression'):
+            val = val.resolve_expression(self.query, allow_joins=False, for_save=True)
+            if val.contains_aggregate:
+                raise FieldError("Aggregate functions are not allowed in this query")
+        elif hasattr(val, 'prepare_database_save'):
+            if field.remote_field:
+                val = field.get_db_prep_save(
+                    val.prepare_database_save(field),
+                    connection=self.connection,
+                )
+            else:
+                raise TypeError(
+                    "Tried to update field %s with a model instance, %r. "
+                    "Use a value compatible with %s."
+                    % (field, val, field.__class__.__name__)
+                )
+        else:
+            val = field.get_db_prep_save(val, connection=self.connection)
+
+        # Getting the placeholder for the field.
+        placeholder = '%s'
+        if cast:
+            placeholder = '%%s::%s' % cast_field.cast_db_type(self.connection)
+        self.placeholder = placeholder
+        if hasattr(val, 'as_sql'):
+            sql, params = self.compile(val)
+            return '%s = %s' % (qn(name), sql), list(params), qn
+        elif val is not None or cast:
+            return '%s = %s' % (qn(name), placeholder), [val], qn
+        return '%s = NULL' % qn(name), [], qn
+
+    def compile_update(self):
         table = self.query.base_table
         qn = self.quote_name_unless_alias
         result = ['UPDATE %s' % qn(table)]
         result.append('SET')
         values, update_params = [], []
         for field, model, val in self.query.values:
-            self.name = name = field.column
-            if hasattr(val, 'alter_name'):
-                self.name = name = val.alter_name(name, qn)
-                qn = no_quote_name
-                val = val.value
-            if hasattr(val, 'resolve_expression'):
-                val = val.resolve_expression(self.query, allow_joins=False, for_save=True)
-                if val.contains_aggregate:
-                    raise FieldError("Aggregate functions are not allowed in this query")
-            elif hasattr(val, 'prepare_database_save'):
-                if field.remote_field:
-                    val = field.get_db_prep_save(
-                        val.prepare_database_save(field),
-                        connection=self.connection,
-                    )
-                else:
-                    raise TypeError(
-                        "Tried to update field %s with a model instance, %r. "
-                        "Use a value compatible with %s."
-                        % (field, val, field.__class__.__name__)
-                    )
-            else:
-                val = field.get_db_prep_save(val, connection=self.connection)
-
-            # Getting the placeholder for the field.
-            placeholder = '%s'
-            self.placeholder = placeholder
-            if hasattr(val, 'as_sql'):
-                sql, params = self.compile(val)
-                values.append('%s = %s' % (qn(name), sql))
-                update_params.extend(params)
-            elif val is not None:
-                values.append('%s = %s' % (qn(name), placeholder))
-                update_params.append(val)
-            else:
-                values.append('%s = NULL' % qn(name))
+            sql, params, qn = self.compile_update_value(field, val, qn)
+            values.append(sql)
+            update_params.extend(params)
         if not values:
             return '', ()
         result.append(', '.join(values))
@@ -65,3 +266,56 @@ class SQLUpdateCompiler(BaseUpdateCompiler):
         if where:
             result.append('WHERE %s' % where)
         return ' '.join(result), tuple(update_params + params)
+
+    def compile_bulk_row(self, values):
+        """
+        Returns the SET clauses and params for the values of one row of a bulk
+        update, with each plain value cast to the type it's written to.
+        """
+        query = self.query
+        query.values, query.related_updates = [], {}
+        query.add_update_values(values)
+        if query.related_updates:
+            raise FieldError('Cannot bulk update fields of parent models.')
+        qn = self.quote_name_unless_alias
+        set_sqls, row_params = [], []
+        for field, model, val in query.values:
+            sql, params, qn = self.compile_update_value(field, val, qn, cast=True)
+            set_sqls.append(sql)
+            row_params.extend(params)
+        return tuple(set_sqls), row_params
+
+    def bulk_as_sql(self, set_sqls, rows):
+        """
+        Creates an UPDATE ... FROM (VALUES ...) statement writing the params of each
+        (pk, params) row into the placeholders of set_sqls for the row with that pk.
+        """
+        qn = self.quote_name_unless_alias
+        opts = self.query.get_meta()
+        table = self.query.base_table
+        columns = []
+
+        def column_ref(match):
+            if match.group() == '%%':
+                return '%%'
+            columns.append('_%s' % len(columns))
+            return 'bulk_update.%s' % columns[-1]
+
+        set_sql = re.sub(r'%[%s]', column_ref, ', '.join(set_sqls))
+        pk_placeholder = '%%s::%s' % opts.pk.rel_db_type(self.connection)
+        values_sql, params = [], []
+        for pk, row_params in rows:
+            placeholders = [pk_placeholder]
+            placeholders.extend('%s::jsonb' if isinstance(param, Json) else '%s' for param in row_params)
+            values_sql.append('(%s)' % ', '.join(placeholders))
+            params.append(opts.pk.get_db_prep_value(pk, self.connection))
+            params.extend(row_params)
+        result = [
+            'UPDATE %s SET %s' % (qn(table), set_sql),
+            'FROM (VALUES %s) AS bulk_update (_pk, %s)' % (', '.join(values_sql), ', '.join(columns)),
+            'WHERE %s.%s = bulk_update._pk' % (qn(table), qn(opts.pk.column)),
+        ]
+        where, where_params = self.compile(self.query.where)
+        if where:
+            result.append('AND %s' % where)
+        return ' '.join(result), tuple(params) + tuple(where_params)
@@ -1,3 +1,6 @@
+from django.db.models.sql.datastructures import Join
+
+
 # class Join(BaseJoin):
 
 def as_sql(self, compiler, connection):
@@ -45,4 +48,48 @@ def as_sql(self, compiler, connection):
     on_clause_sql = ' AND '.join(join_conditions)
     alias_str = '' if self.table_alias == self.table_name else (' %s' % self.table_alias)
     sql = '%s %s%s ON (%s)' % (self.join_type, qn(self.table_name), alias_str, on_clause_sql)
+    if hasattr(self.join_field, 'get_join_prefix'):
+        (lhs_col, rhs_col), = self.join_cols
+        sql = self.join_field.get_join_prefix(self.join_type, qn(self.parent_alias), qn2(lhs_col),
+                                              qn(self.table_alias)) + sql
     return sql, params
+
+
+class ArrayUnnestJoin(Join):
+    """
+    Joins a table against the unnested array column of an ArrayManyToManyField for
+    a set of owner rows, exposing the owner pk and the (1-based) position of each
+    array element:
+       INNER JOIN (SELECT owner.pk AS parent_pk, value, position FROM owner,
+       UNNEST(owner.array_col) WITH ORDINALITY ... WHERE owner.pk = ANY(%s)) alias ON ...
+    The owner pks are bound as a single array parameter.
+    """
+    def __init__(self, table_name, parent_alias, table_alias, join_type, join_field, nullable,
+                 filtered_relation=None, parent_pks=()):
+        super(ArrayUnnestJoin, self).__init__(table_name, parent_alias, table_alias, join_type, join_field,
+                                              nullable, filtered_relation=filtered_relation)
+        self.parent_pks = parent_pks
+
+    def as_sql(self, compiler, connection):
+        qn = compiler.quote_name_unless_alias
+        qn2 = connection.ops.quote_name
+        opts = self.join_field.model._meta
+        (lhs_col, rhs_col), = self.join_cols
+        subquery = (
+            'SELECT %(table)s.%(pk)s AS parent_pk, unnested.value, unnested.position '
+            'FROM %(table)s, UNNEST(%(table)s.%(column)s) WITH ORDINALITY AS unnested (value, position) '
+            'WHERE %(table)s.%(pk)s = ANY(%%s::%(pk_type)s[])' % {
+                'table': qn2(opts.db_table),
+                'pk': qn2(opts.pk.column),
+                'column': qn2(lhs_col),
+                'pk_type': opts.pk.rel_db_type(connection),
+            })
+        sql = '%s (%s) %s ON (%s.%s = %s.value)' % (
+            self.join_type, subquery, qn(self.table_alias), qn(self.parent_alias), qn2(rhs_col),
+            qn(self.table_alias))
+        return sql, [list(self.parent_pks)]
+
+    def relabeled_clone(self, change_map):
+        clone = super(ArrayUnnestJoin, self).relabeled_clone(change_map)
+        clone.parent_pks = self.parent_pks
+        return clone
@@ -4,6 +4,23 @@ from django.utils import six
 
 
 class UpdateQuery(BaseUpdateQuery):
+    returning = ()
+
+    def add_returning_fields(self, names):
+        """
+        Sets the fields whose new values are returned by the update.
+        """
+        opts = self.get_meta()
+        fields = []
+        for name in names:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            if not field.concrete or field.model._meta.concrete_model is not opts.concrete_model:
+                raise FieldError(
+                    'Cannot return field %r (only concrete fields of the updated table are permitted).' % field
+                )
+            fields.append(field)
+        self.returning = tuple(fields)
+
     def add_update_values(self, values):
         """
         Convert a dictionary of field name to value mappings into an update
@@ -11,13 +28,21 @@ class UpdateQuery(BaseUpdateQuery):
         querysets.
         """
         values_seq = []
+        chained = {}
         for name, val in six.iteritems(values):
             if '__' in name:
                 indexes = name.split('__')
                 field_name = indexes.pop(0)
                 field = self.get_meta().get_field(field_name)
+                if field in chained:
+                    position = chained[field]
+                    values_seq[position] = (field, field.model, field.get_update_type(
+                        indexes, val, base=values_seq[position][2]))
+                    continue
                 val = field.get_update_type(indexes, val)
                 model = field.model
+                if getattr(field, 'chain_updates', False):
+                    chained[field] = len(values_seq)
             else:
                 field = self.get_meta().get_field(name)
                 direct = not (field.auto_created and not field.concrete) or not field.concrete
@@ -1,11 +1,19 @@
 class UpdateArrayByIndex(object):
+    """
+    Updates array elements by index. An index can also be a (start, end) tuple to
+    assign a slice, in which case the value is an array.
+    """
 
     def __init__(self, indexes, value, field):
         self.indexes = indexes
         self.value = value
         self.base_field = field.base_field
+        self.is_slice = any(isinstance(index, tuple) for index in indexes)
 
     def alter_name(self, name, qn):
         for index in self.indexes:
-            name += "[%s]" % index
+            if isinstance(index, tuple):
+                name += "[%s:%s]" % index
+            else:
+                name += "[%s]" % index
         return name
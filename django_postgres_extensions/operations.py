@@ -0,0 +1,80 @@
+from django.db import NotSupportedError
+from django.db.migrations.operations.base import Operation
+
+
+class ArrayIndexConcurrentlyMixin(object):
+    """
+    Builds or drops the GIN index of an array field CONCURRENTLY, so writes to
+    the table aren't blocked while it runs. The index uses the options of field, or
+    of the field in the migration state if it isn't given. Migrations using these
+    operations need atomic = False.
+    """
+    reversible = True
+
+    def __init__(self, model_name, name, field=None):
+        self.model_name = model_name
+        self.name = name
+        self.field = field
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _check_atomic(self, schema_editor):
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError(
+                'The %s operation cannot be executed inside a transaction (set atomic = False on the '
+                'Migration class).' % self.__class__.__name__)
+
+    def _get_field(self, model):
+        if self.field is None:
+            return model._meta.get_field(self.name)
+        # Inside SeparateDatabaseAndState the state doesn't include the state
+        # operations yet, so the field has to be passed to the operation.
+        field = self.field.clone()
+        field.set_attributes_from_name(self.name)
+        field.model = model
+        return field
+
+    def _create_index(self, app_label, schema_editor, state):
+        self._check_atomic(schema_editor)
+        model = state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            statement = schema_editor._create_array_index_sql(model, self._get_field(model), concurrently=True)
+            if statement is None:
+                raise ValueError(
+                    '%s.%s has no GIN index to create. Set db_index=True on the field, passing it to %s as field '
+                    'if the state change isn\'t applied yet.' % (self.model_name, self.name, self.__class__.__name__))
+            schema_editor.execute(statement)
+
+    def _drop_index(self, app_label, schema_editor, state):
+        self._check_atomic(schema_editor)
+        model = state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(schema_editor._delete_array_index_sql(model, self._get_field(model),
+                                                                        concurrently=True))
+
+
+class CreateArrayIndexConcurrently(ArrayIndexConcurrentlyMixin, Operation):
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._create_index(app_label, schema_editor, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._drop_index(app_label, schema_editor, from_state)
+
+    def describe(self):
+        return 'Concurrently create the GIN index of %s.%s' % (self.model_name, self.name)
+
+
+class DropArrayIndexConcurrently(ArrayIndexConcurrentlyMixin, Operation):
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._drop_index(app_label, schema_editor, from_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._create_index(app_label, schema_editor, to_state)
+
+    def describe(self):
+        return 'Concurrently drop the GIN index of %s.%s' % (self.model_name, self.name)
@@ -1,4 +1,22 @@
+import warnings
+
+from django.dispatch import Signal
+
+# Sent once per batch by the bulk_add, bulk_remove and bulk_set methods of array
+# many to many descriptors. pk_sets maps the pk of each model with the array field
+# to the list of related pks added or removed.
+m2m_bulk_changed = Signal(providing_args=['action', 'reverse', 'model', 'pk_sets', 'using'])
+
+
 def delete_reverse_related(sender, signal, instance, using, **kwargs):
+    """
+    Deprecated: deleted objects are removed from array many to many fields by the
+    Collector.delete patch installed when ENABLE_ARRAY_M2M is set, so this receiver
+    no longer needs to be connected to pre_delete.
+    """
+    warnings.warn(
+        'delete_reverse_related is deprecated, deleted objects are removed from array many to many '
+        'fields automatically when ENABLE_ARRAY_M2M is set.', DeprecationWarning, stacklevel=2)
     for related in instance._meta.related_objects:
         field = related.field
         if getattr(field, 'many_to_many_array', False):
@@ -8,7 +8,7 @@ from django_postgres_extensions.models.fields.related import ArrayField
 
 class Product(models.Model):
     name = models.CharField(max_length=3)
-    tags = ArrayField(models.CharField(max_length=15), null=True, blank=True)
+    tags = ArrayField(models.CharField(max_length=15), null=True, blank=True, db_index=True)
     moretags = ArrayField(models.CharField(max_length=15), null=True, blank=True)
     prices = ArrayField(models.IntegerField(), null=True, blank=True)
     description = HStoreField(null=True, blank=True)
@@ -2,12 +2,20 @@ from __future__ import unicode_literals
 
 from unittest import skip
 
-from django.db import transaction
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db import NotSupportedError, connection, migrations, models, transaction
+from django.db.migrations.state import ProjectState
+from django.db.models import Q
 from django.db.utils import ProgrammingError, DataError
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
+from django_postgres_extensions.models.fields import ArrayField
 from django_postgres_extensions.models.expressions import F, Value as V, Index, SliceArray
 from django_postgres_extensions.models.functions import *
+from django_postgres_extensions.models.sql.compiler import update_sql_cache
+from django_postgres_extensions.operations import CreateArrayIndexConcurrently
 from .models import Product
 
 
@@ -126,6 +134,30 @@ class ArrayCharsFuncTests(TestCase):
             obj = self.queryset.annotate(positions=ArrayPositions('tags', 'Rock')).get()
         self.assertEqual(obj.positions, [1, 4])
 
+    def test_array_chars_any_lookups(self):
+        self.assertTrue(self.queryset.filter(tags__any='Rock').exists())
+        self.assertTrue(self.queryset.filter(tags__any_exact='Album').exists())
+        self.assertFalse(self.queryset.filter(tags__any='Pop').exists())
+        self.assertTrue(self.queryset.filter(tags__any_gt='Album').exists())
+        self.assertFalse(self.queryset.filter(tags__any_lt='Album').exists())
+        queryset = Product.objects.filter(tags__any='Rock')
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('@> ARRAY[%s]::varchar(15)[]', sql)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('Index Scan', plan)
+        self.assertIn('tags', plan)
+
+    def test_array_chars_set_functions(self):
+        output_field = Product._meta.get_field('tags')
+        with transaction.atomic():
+            self.queryset.update(tags=ArrayDifference('tags', ['Album'], output_field=output_field))
+            obj = self.queryset.annotate(tags_union=ArrayUnion('tags', 'moretags')).get()
+        self.assertListEqual(obj.tags, ['Music', 'Rock'])
+        self.assertListEqual(obj.tags_union, ['Music', 'Rock', 'Very Popular'])
+
 
 class ArrayCharsCatTests(TestCase):
     def setUp(self):
@@ -210,10 +242,268 @@ class ArrayIntTests(TestCase):
         product = self.queryset.get()
         self.assertListEqual(product.prices, [-1, 0, 1, 2, 3])
 
+    def test_array_int_cat_unique(self):
+        with transaction.atomic():
+            self.queryset.update(prices=ArrayCatUnique('prices', [4, 1, 3, 4, 0, 5],
+                                                       output_field=Product._meta.get_field('prices')))
+        product = self.queryset.get()
+        self.assertListEqual(product.prices, [0, 1, 2, 4, 3, 5])
+
+    def test_array_int_remove_many(self):
+        output_field = Product._meta.get_field('prices')
+        with transaction.atomic():
+            self.queryset.update(prices=ArrayCat('prices', [1, 3, 0], output_field=output_field))
+            self.queryset.update(prices=ArrayRemoveMany('prices', [5, 1, 0], output_field=output_field))
+        product = self.queryset.get()
+        self.assertListEqual(product.prices, [2, 3])
+
+    def test_array_int_set_functions(self):
+        output_field = Product._meta.get_field('prices')
+        with transaction.atomic():
+            self.queryset.update(prices=ArrayCat('prices', [1, 0, 7], output_field=output_field))
+            obj = self.queryset.annotate(
+                distinct=ArrayDistinct('prices'),
+                union=ArrayUnion('prices', [9, 2, 9, 3], output_field=output_field),
+                intersect=ArrayIntersect('prices', [7, 2, 0, 5], output_field=output_field),
+                difference=ArrayDifference('prices', [1, 5], output_field=output_field),
+                sorted_union=ArrayUnion('prices', [9, 3], output_field=output_field, sort=True)).get()
+            self.queryset.update(prices=ArrayUnion('prices', [5, 1], output_field=output_field))
+        self.assertListEqual(obj.distinct, [0, 1, 2, 7])
+        self.assertListEqual(obj.union, [0, 1, 2, 7, 9, 3])
+        self.assertListEqual(obj.intersect, [0, 2, 7])
+        self.assertListEqual(obj.difference, [0, 2, 7])
+        self.assertListEqual(obj.sorted_union, [0, 1, 2, 3, 7, 9])
+        self.assertListEqual(self.queryset.get().prices, [0, 1, 2, 7, 5])
+
+    def test_array_int_intarray(self):
+        field = Product._meta.get_field('prices')
+        self.assertNotIn('intarray', field.deconstruct()[3])
+        field.intarray = True
+        connection.installed_extensions = frozenset(['intarray'])
+        try:
+            self.assertEqual(field.deconstruct()[3]['intarray'], True)
+            self.assertTrue(field.uses_intarray(connection))
+            field.db_index = True
+            with connection.schema_editor() as editor:
+                index_sql = str(editor._create_array_index_sql(Product, field))
+            union_sql = str(self.queryset.annotate(union=ArrayUnion('prices', [1, 5], output_field=field)).query)
+            remove_sql = str(self.queryset.annotate(removed=ArrayRemoveMany('prices', [1], output_field=field)).query)
+            distinct_sql = str(self.queryset.annotate(distinct=ArrayDistinct('prices', sort=True)).query)
+        finally:
+            field.intarray, field.db_index = None, False
+            del connection.installed_extensions
+        self.assertFalse(field.uses_intarray(connection))
+        self.assertIn('gin__int_ops', index_sql)
+        self.assertIn('| ', union_sql)
+        self.assertNotIn('UNNEST', union_sql)
+        self.assertIn('ORDER BY existing.position', remove_sql)
+        self.assertIn('UNIQ(SORT(', distinct_sql)
+
+    def test_installed_extensions_refreshed(self):
+        self.assertIn('plpgsql', connection.installed_extensions)
+        with connection.schema_editor() as editor:
+            editor.execute('CREATE EXTENSION IF NOT EXISTS plpgsql')
+        self.assertNotIn('installed_extensions', connection.__dict__)
+        self.assertIn('plpgsql', connection.installed_extensions)
+        connection.init_connection_state()
+        self.assertNotIn('installed_extensions', connection.__dict__)
+
+    def test_array_int_multi_func(self):
+        with transaction.atomic():
+            self.queryset.update(prices=multi_array_append('prices', *range(3, 1003)))
+            self.queryset.update(prices=multi_array_remove('prices', *range(1, 1000)))
+            self.queryset.update(prices=multi_array_replace('prices', (0, 7), (1000, 8), (1002, 9)))
+        self.assertListEqual(self.queryset.get().prices, [7, 8, 1001, 9])
+
+    def test_array_int_update_slice(self):
+        with transaction.atomic():
+            self.queryset.update(prices__1_2=[5, 6])
+        product = self.queryset.get()
+        self.assertListEqual(product.prices, [0, 5, 6])
+        Product.objects.bulk_update_values([(self.product.pk, {'prices__0_1': ['7', 8]})])
+        self.assertListEqual(self.queryset.get().prices, [7, 8, 6])
+
+    def test_array_int_update_returning(self):
+        other = Product.objects.create(name='abc', prices=[5])
+        with transaction.atomic():
+            rows = Product.objects.order_by().update_returning(['pk', 'prices'], prices=ArrayAppend('prices', 3))
+        self.assertNotIsInstance(rows, (int, list))
+        self.assertEqual(sorted(rows), [(self.product.pk, [0, 1, 2, 3]), (other.pk, [5, 3])])
+        rows = self.queryset.update_returning(['prices'], prices__0=7)
+        self.assertListEqual(list(rows), [([7, 1, 2, 3],)])
+        self.assertListEqual(list(Product.objects.filter(pk=0).update_returning(['name'], name='def')), [])
+        self.assertRaises(FieldDoesNotExist, self.queryset.update_returning, ['missing'], name='def')
+        # update() treats returning as a field name like any other keyword
+        self.assertRaises(FieldDoesNotExist, self.queryset.update, name='def', returning=['name'])
+
     def test_array_int_raises(self):
         self.assertRaises(DataError, self.queryset.update, prices=ArrayAppend('prices', 'test'))
 
 
+class UpdateSQLCacheTests(TestCase):
+    def setUp(self):
+        super(UpdateSQLCacheTests, self).setUp()
+        self.product = Product.objects.create(name='xyz', prices=[0, 1, 2])
+        self.other = Product.objects.create(name='abc', prices=[5, 6, 7])
+        update_sql_cache.cache_clear()
+
+    def test_update_sql_cached(self):
+        for pk, price in ((self.product.pk, 3), (self.other.pk, 8), (self.product.pk, 4)):
+            Product.objects.filter(pk=pk).update(prices__2=price)
+        self.assertEqual(update_sql_cache.cache_info()[:2], (2, 1))
+        self.assertListEqual(Product.objects.get(pk=self.product.pk).prices, [0, 1, 4])
+        self.assertListEqual(Product.objects.get(pk=self.other.pk).prices, [5, 6, 8])
+        Product.objects.filter(pk__in=[self.product.pk, self.other.pk]).update(prices__0=9, tags=None)
+        Product.objects.filter(pk__in=[self.product.pk]).update(prices__0=10, tags=['Rock'])
+        self.assertEqual(update_sql_cache.cache_info()[1:], (3, 128, 3))
+        self.assertListEqual(Product.objects.get(pk=self.product.pk).prices, [10, 1, 4])
+        self.assertIsNone(Product.objects.get(pk=self.other.pk).tags)
+
+    def test_update_sql_not_cached(self):
+        Product.objects.filter(pk=self.product.pk).update(prices=ArrayAppend('prices', 3))
+        Product.objects.filter(pk__in=[]).update(name='def')
+        self.assertEqual(update_sql_cache.cache_info(), (0, 0, 128, 0))
+        with self.settings(UPDATE_SQL_CACHE_SIZE=0):
+            Product.objects.filter(pk=self.product.pk).update(name='def')
+            self.assertEqual(update_sql_cache.cache_info(), (0, 0, 0, 0))
+        self.assertListEqual(Product.objects.get(pk=self.product.pk).prices, [0, 1, 2, 3])
+
+
+class ArrayBulkUpdateTests(TestCase):
+    def setUp(self):
+        super(ArrayBulkUpdateTests, self).setUp()
+        self.products = [
+            Product.objects.create(name=name, prices=[0, 1, 2], coordinates=[[0, 1], [2, 3]])
+            for name in ('abc', 'def', 'ghi')
+        ]
+
+    def test_bulk_update_values(self):
+        a, b, c = self.products
+        rows = [
+            (a.pk, {'prices__2': 5, 'name': 'xyz'}),
+            (b.pk, {'prices__2': '6', 'name': 'uvw'}),
+            (c.pk, {'prices__0': 7}),
+            (a.pk, {'coordinates__1__0': 8, 'prices__0': None}),
+        ]
+        with CaptureQueriesContext(connection) as captured:
+            updated = Product.objects.bulk_update_values(rows)
+        self.assertEqual(updated, 4)
+        self.assertEqual(len([query for query in captured.captured_queries if query['sql'].startswith('UPDATE')]), 3)
+        a, b, c = [Product.objects.get(pk=product.pk) for product in self.products]
+        self.assertEqual((a.name, a.prices, a.coordinates), ('xyz', [None, 1, 5], [[0, 1], [8, 3]]))
+        self.assertEqual((b.name, b.prices), ('uvw', [0, 1, 6]))
+        self.assertEqual((c.name, c.prices), ('ghi', [7, 1, 2]))
+
+    def test_bulk_update_values_batches(self):
+        rows = [(product.pk, {'prices__1': product.pk}) for product in self.products]
+        with CaptureQueriesContext(connection) as captured:
+            updated = Product.objects.filter(name__in=['abc', 'ghi']).bulk_update_values(rows, batch_size=2)
+        self.assertEqual(updated, 2)
+        self.assertEqual(len([query for query in captured.captured_queries if query['sql'].startswith('UPDATE')]), 2)
+        self.assertListEqual([product.prices[1] for product in Product.objects.order_by('pk')],
+                             [self.products[0].pk, 1, self.products[2].pk])
+
+    def test_bulk_update_values_duplicate_pks(self):
+        a = self.products[0]
+        with self.assertNumQueries(0):
+            self.assertRaises(ValueError, Product.objects.bulk_update_values,
+                              [(a.pk, {'prices__0': 7}), (str(a.pk), {'prices__0': 8})])
+        self.assertListEqual(Product.objects.get(pk=a.pk).prices, [0, 1, 2])
+
+
+class ArrayIndexTests(TestCase):
+    def setUp(self):
+        super(ArrayIndexTests, self).setUp()
+        self.field = ArrayField(models.IntegerField(), db_index=True, fastupdate=False, gin_pending_list_limit=512,
+                                index_opclass='array_ops', index_condition=Q(prices__len__gt=0))
+        self.field.set_attributes_from_name('prices')
+        self.field.model = Product
+
+    def test_array_index_options(self):
+        kwargs = self.field.deconstruct()[3]
+        self.assertEqual(kwargs['fastupdate'], False)
+        self.assertEqual(kwargs['gin_pending_list_limit'], 512)
+        self.assertNotIn('index_concurrently', kwargs)
+        with connection.schema_editor() as editor:
+            sql = str(editor._create_array_index_sql(Product, self.field))
+            self.assertIn('USING GIN ("prices" array_ops) WITH (fastupdate = off, gin_pending_list_limit = 512)', sql)
+            self.assertIn(' WHERE CASE WHEN "prices" IS NULL', sql)
+            editor.execute(sql)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Product._meta.db_table)
+        index_name = editor._create_index_name(Product._meta.db_table, ['prices'], suffix='_gin')
+        self.assertEqual(constraints[index_name]['type'], 'gin')
+
+    def test_array_index_concurrently(self):
+        self.field.index_concurrently = True
+        with connection.schema_editor() as editor:
+            sql = str(editor._create_array_index_sql(Product, self.field))
+            self.assertTrue(sql.startswith('CREATE INDEX "'))
+            sql = str(editor._create_array_index_sql(Product, self.field, concurrently=True))
+            self.assertTrue(sql.startswith('CREATE INDEX CONCURRENTLY '))
+            sql = str(editor._delete_array_index_sql(Product, self.field, concurrently=True))
+            self.assertTrue(sql.startswith('DROP INDEX CONCURRENTLY IF EXISTS '))
+            operation = CreateArrayIndexConcurrently('Product', 'tags')
+            self.assertRaises(NotSupportedError, operation.database_forwards, 'arrays', editor, None, None)
+
+
+class ArrayIndexMigrationTests(TransactionTestCase):
+    available_apps = ['arrays']
+
+    def index_exists(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+            return cursor.fetchone() is not None
+
+    def test_array_index_concurrently_migration(self):
+        field = ArrayField(models.IntegerField(), null=True, blank=True, db_index=True)
+        operation = migrations.SeparateDatabaseAndState(
+            state_operations=[migrations.AlterField('Product', 'prices', field=field)],
+            database_operations=[CreateArrayIndexConcurrently('Product', 'prices', field=field)],
+        )
+        from_state = ProjectState.from_apps(apps)
+        to_state = from_state.clone()
+        operation.state_forwards('arrays', to_state)
+        with connection.schema_editor(atomic=False) as editor:
+            index_name = editor._create_index_name(Product._meta.db_table, ['prices'], suffix='_gin')
+            operation.database_forwards('arrays', editor, from_state, to_state)
+        self.assertTrue(self.index_exists(index_name))
+        with connection.schema_editor(atomic=False) as editor:
+            operation.database_backwards('arrays', editor, to_state, from_state)
+        self.assertFalse(self.index_exists(index_name))
+
+    def test_array_index_concurrently_no_index(self):
+        operation = CreateArrayIndexConcurrently('Product', 'prices')
+        state = ProjectState.from_apps(apps)
+        with connection.schema_editor(atomic=False) as editor:
+            self.assertRaises(ValueError, operation.database_forwards, 'arrays', editor, state, state)
+
+    def test_array_index_renamed_with_column(self):
+        old_field = Product._meta.get_field('tags')
+        new_field = old_field.clone()
+        new_field.set_attributes_from_name('labels')
+        changed_field = new_field.clone()
+        changed_field.set_attributes_from_name('labels')
+        changed_field.fastupdate = False
+        with connection.schema_editor() as editor:
+            old_name = editor._create_index_name(Product._meta.db_table, ['tags'], suffix='_gin')
+            new_name = editor._create_index_name(Product._meta.db_table, ['labels'], suffix='_gin')
+            editor.alter_field(Product, old_field, new_field)
+        try:
+            self.assertFalse(self.index_exists(old_name))
+            self.assertTrue(self.index_exists(new_name))
+            # Later changes to the index options replace the renamed index
+            with connection.schema_editor() as editor:
+                editor.alter_field(Product, new_field, changed_field)
+            self.assertFalse(self.index_exists(old_name))
+            self.assertTrue(self.index_exists(new_name))
+        finally:
+            with connection.schema_editor() as editor:
+                editor.alter_field(Product, changed_field, old_field)
+        self.assertTrue(self.index_exists(old_name))
+        self.assertFalse(self.index_exists(new_name))
+
+
 class ArrayMultiDimensionalTests(TestCase):
     def setUp(self):
         super(ArrayMultiDimensionalTests, self).setUp()
@@ -229,6 +519,16 @@ class ArrayMultiDimensionalTests(TestCase):
         array_values = product.coordinates
         self.assertListEqual(array_values, [[0, 15, 25], [15, 30, 40], [45, 60, 90]])
 
+    def test_2d_array_update_slice(self):
+        with transaction.atomic():
+            self.queryset.update(coordinates__1_2__0_1=[[1, 2], [3, 4]])
+        product = self.queryset.get()
+        self.assertListEqual(product.coordinates, [[0, 15, 25], [1, 2, 40], [3, 4, 90]])
+        with transaction.atomic():
+            self.queryset.update(coordinates__0__1_2=[[5, 6]])
+        product = self.queryset.get()
+        self.assertListEqual(product.coordinates, [[0, 5, 6], [1, 2, 40], [3, 4, 90]])
+
     def test_2d_array_dimensions(self):
         with transaction.atomic():
             obj = self.queryset.annotate(coordinates_dims=ArrayDims('coordinates')).get()
@@ -6,22 +6,25 @@ from django.db import connections
 from django.test import TestCase
 from django.test import tag
 
-from django_postgres_extensions.models.functions import ArrayAppend, ArrayCat
+from django_postgres_extensions.models.functions import ArrayAppend, ArrayCat, ArrayRemoveMany, multi_array_remove
+from django_postgres_extensions.models.sql import UpdateQuery
 from .models import Traditional, NumberArray, NumberTraditional, Array
 
+timer = getattr(time, 'perf_counter', None) or time.clock
+
 
 @tag('benchmark')
 class BaseBenchmark(TestCase):
     def checkTimes(self, text, func1, func2, args1=(), kwargs1=None, args2=(), kwargs2=None, verify_result=None,
                    first="Traditional M2M", second="Array M2M"):
-        start = time.clock()
+        start = timer()
         kwargs = kwargs1 or {}
         result1 = func1(*args1, **kwargs)
-        traditional_time = time.clock() - start
-        start = time.clock()
+        traditional_time = timer() - start
+        start = timer()
         kwargs = kwargs2 or {}
         result2 = func2(*args2, **kwargs)
-        array_time = time.clock() - start
+        array_time = timer() - start
         if verify_result:
             verify_result(result1, result2)
         times = "%s: %s. %s: %s" % (first, traditional_time, second, array_time)
@@ -57,6 +60,23 @@ class ArrayBenchmarks(BaseBenchmark):
         self.checkTimes('Append vs Cat', Array.objects.update, Array.objects.update, kwargs1=kwargs1,
                         kwargs2=kwargs2, first="Append", second="Cat")
 
+    def compile_update(self, expression):
+        query = Array.objects.all().query.chain(UpdateQuery)
+        query.add_update_values({'numbers': expression})
+        return query.get_compiler('default').as_sql()
+
+    def test_multi_func_compile_10000(self):
+        values = list(range(10000))
+        self.checkTimes('Compile 10000 removes', self.compile_update, self.compile_update,
+                        args1=(multi_array_remove('numbers_ids', *values),),
+                        args2=(ArrayRemoveMany('numbers_ids', values),), first="multi_array_remove",
+                        second="ArrayRemoveMany")
+        start = timer()
+        for arg_count in (1000, 10000):
+            self.compile_update(multi_array_remove('numbers_ids', *values[:arg_count]))
+            print("Compile multi_array_remove with %s args: %s" % (arg_count, timer() - start))
+            start = timer()
+
 
 @tag('benchmark')
 class ForwardWriteBenchmarks(BaseBenchmark):
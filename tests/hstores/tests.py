@@ -1,11 +1,16 @@
 from __future__ import unicode_literals
 
-from django.db import transaction
+from collections import OrderedDict
+
+from django.db import connection, models, transaction
 from django.db.utils import ProgrammingError
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, isolate_apps
 
-from django_postgres_extensions.models.expressions import Key, Keys
+from django_postgres_extensions.models.expressions import F, Key, KeyInt, Keys
+from django_postgres_extensions.models.fields import HStoreField
 from django_postgres_extensions.models.functions import *
+from django_postgres_extensions.models.sql import UpdateQuery
 from .models import Product
 
 
@@ -41,6 +46,65 @@ class HStoreIndexTests(TestCase):
         self.assertDictEqual(product.description, {'Industry': 'Music', 'Release': 'Album', 'Genre': 'Heavy Metal',
                                                    'Popularity': 'Very Popular'})
 
+    def test_hstore_update_patch(self):
+        with transaction.atomic():
+            self.queryset.update(description__patch={'Genre': 'Heavy Metal', 'Popularity': 'Very Popular',
+                                                     'Release': None, 'Missing': None})
+        product = self.queryset.get()
+        self.assertDictEqual(product.description, {'Industry': 'Music', 'Genre': 'Heavy Metal',
+                                                   'Popularity': 'Very Popular'})
+
+    def test_hstore_update_patch_streamed(self):
+        patch = dict(('Key%s' % i, 'Value%s' % i) for i in range(20))
+        patch.update({'Release': None, 'Genre': 'Pop'})
+        stream_threshold = HStorePatch.stream_threshold
+        HStorePatch.stream_threshold = 10
+        try:
+            with transaction.atomic():
+                self.queryset.update(description=HStorePatch('description', patch))
+        finally:
+            HStorePatch.stream_threshold = stream_threshold
+        expected = dict(('Key%s' % i, 'Value%s' % i) for i in range(20))
+        expected.update({'Industry': 'Music', 'Genre': 'Pop'})
+        self.assertDictEqual(self.queryset.get().description, expected)
+
+    def test_hstore_update_patch_streamed_on_execute(self):
+        patch = dict(('Key%s' % i, 'Value%s' % i) for i in range(20))
+        stream_threshold = HStorePatch.stream_threshold
+        HStorePatch.stream_threshold = 10
+        try:
+            with transaction.atomic():
+                query = self.queryset.query.chain(UpdateQuery)
+                query.add_update_values({'description': HStorePatch('description', patch)})
+                with CaptureQueriesContext(connection) as captured:
+                    sql = str(query)
+                    query.sql_with_params()
+                self.assertIn('FROM "hstore_patch_', sql)
+                self.assertEqual(len(captured.captured_queries), 0)
+                with CaptureQueriesContext(connection) as captured:
+                    self.queryset.update(description=HStorePatch('description', patch))
+        finally:
+            HStorePatch.stream_threshold = stream_threshold
+        creates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('CREATE TEMPORARY')]
+        self.assertEqual(len(creates), 1)
+        self.assertTrue(captured.captured_queries[-1]['sql'].startswith('UPDATE'))
+
+    def test_hstore_increment(self):
+        with transaction.atomic():
+            self.queryset.update(description__inc__Plays=2)
+            self.queryset.update(description=F('description').increment('Plays'))
+            self.queryset.update(description=F('description').increment_many({'Plays': 1, 'Skips': -1}, default=10))
+        description = self.queryset.get().description
+        self.assertEqual(description['Plays'], '4')
+        self.assertEqual(description['Skips'], '9')
+
+    def test_hstore_increment_several_keys(self):
+        with transaction.atomic():
+            self.queryset.update(description__inc__Plays=2, description__inc__Skips=-1)
+        description = self.queryset.get().description
+        self.assertEqual(description['Plays'], '2')
+        self.assertEqual(description['Skips'], '-1')
+
     def test_hstore_raw_int_raises(self):
         with transaction.atomic():
             self.queryset.update(description__={'Popularity': 5})
@@ -137,3 +201,56 @@ class HstoreFuncTests(TestCase):
             product = qs.get()
         self.assertDictEqual(product.description__alt,
                              {'Genre': 'Rock', 'Release': 'Album', 'Industry': 'Music', 'Rating': 8})
+
+
+@isolate_apps('hstores')
+class HStoreKeyIndexTests(TestCase):
+
+    def setUp(self):
+        super(HStoreKeyIndexTests, self).setUp()
+
+        class Item(models.Model):
+            attributes = HStoreField(null=True, blank=True, key_indexes=['colour', ('rating', 'integer')],
+                                     containment_index='gist')
+
+        self.model = Item
+
+    def test_hstore_key_index_lookups(self):
+        sql, params = self.model.objects.filter(attributes__rating__gt=3).query.sql_with_params()
+        self.assertIn('(("hstores_item"."attributes" -> %s))::integer > %s', sql)
+        self.assertEqual(params, ('rating', 3))
+        sql, params = self.model.objects.filter(attributes__colour='red').query.sql_with_params()
+        self.assertIn('("hstores_item"."attributes" -> %s) = %s', sql)
+
+    def test_hstore_typed_keys(self):
+        queryset = self.model.objects.annotate(rating=KeyInt('attributes', 'rating')).filter(rating__gt=3)
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('WHERE (("hstores_item"."attributes" -> %s))::integer > %s', sql)
+        queryset = self.model.objects.annotate(Keys('attributes', ['rating', 'stock'], output_field=models.IntegerField()))
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('("hstores_item"."attributes" -> %s))::integer[]', sql)
+
+    def test_hstore_increment_key_with_separator(self):
+        queryset = self.model.objects.annotate(incremented=F('attributes').increment('size__cm', 2))
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('size__cm', params)
+        self.assertNotIn('#>>', sql)
+
+    def test_hstore_update_lookups_chained(self):
+        query = self.model.objects.all().query.chain(UpdateQuery)
+        query.add_update_values(OrderedDict([
+            ('attributes__inc__views', 1), ('attributes__inc__likes', 2), ('attributes__del', 'stale'),
+        ]))
+        sql, params = query.get_compiler('default').as_sql()
+        self.assertEqual(sql.count('"attributes" ='), 1)
+        self.assertEqual(sql.count('UNNEST('), 1)
+        self.assertIn(['views', 'likes'], params)
+        self.assertIn('stale', params)
+
+    def test_hstore_key_index_schema(self):
+        with connection.schema_editor(collect_sql=True) as editor:
+            editor.create_model(self.model)
+        sql = '\n'.join(editor.collected_sql)
+        self.assertIn('USING GIST ("attributes")', sql)
+        self.assertIn('(((("attributes" -> \'rating\'))::integer))', sql)
+        self.assertIn('((("attributes" -> \'colour\')))', sql)
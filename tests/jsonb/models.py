@@ -5,3 +5,5 @@ from django_postgres_extensions.models.fields import JSONField
 class Product(models.Model):
     name = models.CharField(max_length=3)
     description = JSONField(null=True, blank=True)
+    data = JSONField(null=True, blank=True, key_indexes=['user__name', ('user__id', 'integer')],
+                     containment_index='gin', index_opclass='jsonb_path_ops')
@@ -1,11 +1,16 @@
 from __future__ import unicode_literals, absolute_import
 
+from datetime import datetime
+
 from django.test import TestCase
 from .models import Product
 from django_postgres_extensions.models.functions import *
-from django_postgres_extensions.models.expressions import Key
+from django_postgres_extensions.models.expressions import F, Key, KeyBool, KeyFloat, KeyInt, KeyTimestamp
 from psycopg2.extras import Json
-from django.db import transaction
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+from django_postgres_extensions.models.fields import JSONField
 
 
 class JSONIndexTests(TestCase):
@@ -70,6 +75,81 @@ class JSONIndexTests(TestCase):
                              {'Industry': 'Music', 'Details': {'Genre': 'Rock', 'Rating': 8},
                               'Price': 9.99, 'Tags': ['Heavy']})
 
+    def test_json_update_deep_patch(self):
+        with transaction.atomic():
+            self.queryset.update(description__set__Details__Genre='Heavy Metal',
+                                 description__inc__Details__Rating=2,
+                                 description__inc__Details__Plays=1,
+                                 description__append__Tags='Loud',
+                                 description__append__Formats=['CD', 'Vinyl'],
+                                 description__del='Industry')
+        product = self.queryset.get()
+        self.assertDictEqual(product.description,
+                             {'Details': {'Release': 'Album', 'Genre': 'Heavy Metal', 'Rating': 10, 'Plays': 1},
+                              'Price': 9.99, 'Tags': ['Heavy', 'Guitar', 'Loud'], 'Formats': ['CD', 'Vinyl']})
+        with transaction.atomic():
+            self.queryset.update(description__inc__Price=0.01, description__set__Tags__0={'Name': 'Metal'})
+        product = self.queryset.get()
+        self.assertEqual(product.description['Price'], 10)
+        self.assertListEqual(product.description['Tags'], [{'Name': 'Metal'}, 'Guitar', 'Loud'])
+        self.assertRaises(ValueError, self.queryset.update, description__set=1)
+
+    def test_json_increment(self):
+        other = Product.objects.create(name='abc')
+        queryset = Product.objects.filter(pk__in=[self.product.pk, other.pk])
+        with transaction.atomic():
+            queryset.update(description=F('description').increment('Plays'))
+            queryset.update(description=F('description').increment('Details__Rating', 2, default=5))
+            queryset.update(description=F('description').increment_many({'Plays': 2, 'Price': 1, 'Skips': -1}))
+        product = self.queryset.get()
+        self.assertEqual(product.description['Plays'], 3)
+        self.assertEqual(product.description['Price'], 10.99)
+        self.assertEqual(product.description['Skips'], -1)
+        self.assertEqual(product.description['Details']['Rating'], 10)
+        self.assertDictEqual(Product.objects.get(pk=other.pk).description,
+                             {'Plays': 3, 'Price': 1, 'Skips': -1, 'Details': {'Rating': 7}})
+
+    def test_json_increment_lookup(self):
+        first, second = Product.objects.create(name='abc'), Product.objects.create(name='def')
+        Product.objects.filter(pk=first.pk).update(description__inc__Plays=2)
+        Product.objects.filter(pk=second.pk).update(description=F('description').increment('Plays', 2))
+        self.assertDictEqual(Product.objects.get(pk=first.pk).description, {'Plays': 2})
+        self.assertDictEqual(Product.objects.get(pk=second.pk).description, {'Plays': 2})
+        Product.objects.filter(pk=first.pk).update(description=JSONBIncrement('description', ['Skips'], 1, default=5))
+        self.assertDictEqual(Product.objects.get(pk=first.pk).description, {'Plays': 2, 'Skips': 6})
+
+    def test_json_update_missing_parents(self):
+        other = Product.objects.create(name='abc', description={'Details': {'Rating': 1}})
+        queryset = Product.objects.filter(pk__in=[self.product.pk, other.pk])
+        queryset.update(description__inc__Counters__Views=1, description__set__Meta__Source__Name='import',
+                        description__append__Lists__Recent='a')
+        queryset.update(description=F('description').increment_many({'Counters__Views': 1, 'Counters__Clicks': 2,
+                                                                      'Details__Rating': 1}))
+        empty = Product.objects.create(name='def')
+        Product.objects.filter(pk=empty.pk).update(description__inc__Counters__Views=1)
+        expected = {'Counters': {'Views': 2, 'Clicks': 2}, 'Meta': {'Source': {'Name': 'import'}},
+                    'Lists': {'Recent': ['a']}}
+        description = Product.objects.get(pk=other.pk).description
+        self.assertDictEqual(description, dict(expected, Details={'Rating': 2}))
+        description = self.queryset.get().description
+        self.assertDictEqual(description['Details'], {'Release': 'Album', 'Genre': 'Rock', 'Rating': 9})
+        self.assertDictEqual(description['Counters'], expected['Counters'])
+        self.assertDictEqual(Product.objects.get(pk=empty.pk).description, {'Counters': {'Views': 1}})
+
+    def test_json_bulk_update_values(self):
+        other = Product.objects.create(name='abc', description={'Industry': 'Film', 'Price': 5})
+        Product.objects.bulk_update_values([
+            (self.product.pk, {'description__': {'Industry': 'Movie', 'Popularity': 'Very Popular'}}),
+            (other.pk, {'description__': {'Price': 6}}),
+            (other.pk, {'description__del': 'Industry'}),
+            (self.product.pk, {'description__del': 'Details__Genre'}),
+        ])
+        product = self.queryset.get()
+        self.assertDictEqual(product.description,
+                             {'Industry': 'Movie', 'Details': {'Release': 'Album', 'Rating': 8},
+                              'Price': 9.99, 'Popularity': 'Very Popular', 'Tags': ['Heavy', 'Guitar']})
+        self.assertDictEqual(Product.objects.get(pk=other.pk).description, {'Price': 6})
+
 
 class JSONFuncTests(TestCase):
     def setUp(self):
@@ -107,3 +187,100 @@ class JSONFuncTests(TestCase):
             qs = self.queryset2.format('description', JSONBArrayLength, output_field='desc_length')
             obj = qs.get()
         self.assertEqual(obj.desc_length, 2)
+
+
+class JSONKeyIndexTests(TestCase):
+
+    def setUp(self):
+        super(JSONKeyIndexTests, self).setUp()
+        Product.objects.bulk_create([Product(name='p%s' % i, data={'user': {'id': i, 'name': 'user%s' % i}})
+                                     for i in range(20)])
+
+    def tearDown(self):
+        Product.objects.all().delete()
+
+    def assertUsesIndex(self, queryset, index_name):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+            try:
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.execute('SET enable_seqscan = on')
+        self.assertIn(index_name, plan)
+
+    def get_index_name(self, *options):
+        with connection.schema_editor() as editor:
+            name = editor._key_index_name(Product, Product._meta.get_field('data'), options)
+        with connection.cursor() as cursor:
+            self.assertIn(name, connection.introspection.get_constraints(cursor, Product._meta.db_table))
+        return name
+
+    def test_json_key_index_lookups(self):
+        self.assertEqual(Product.objects.get(data__user__id=5).name, 'p5')
+        self.assertEqual(Product.objects.filter(data__user__id__gte=15).count(), 5)
+        self.assertEqual(Product.objects.get(data__user__name='user7').name, 'p7')
+        self.assertEqual(Product.objects.filter(data__user__name__startswith='user1').count(), 11)
+        sql, params = Product.objects.filter(data__user__id=5).query.sql_with_params()
+        self.assertIn('(("jsonb_product"."data" #>> %s))::integer = %s', sql)
+        self.assertEqual(params, ('{"user","id"}', 5))
+
+    def test_json_key_index_values(self):
+        obj = Product.objects.annotate(Key('data', 'user__id')).get(name='p3')
+        self.assertEqual(obj.data__user__id, 3)
+        obj = Product.objects.annotate(Key('data', 'user__name')).get(name='p3')
+        self.assertEqual(obj.data__user__name, 'user3')
+        obj = Product.objects.annotate(Key('data', 'user')).get(name='p3')
+        self.assertDictEqual(obj.data__user, {'id': 3, 'name': 'user3'})
+
+    def test_json_key_index_used(self):
+        self.assertUsesIndex(Product.objects.filter(data__user__id=5), self.get_index_name('key', ('user', 'id'), 'integer'))
+        self.assertUsesIndex(Product.objects.filter(data__contains={'user': {'id': 5}}), self.get_index_name('gin', 'jsonb_path_ops'))
+
+    def test_json_typed_keys(self):
+        Product.objects.filter(name='p3').update(data={'user': {'id': 3, 'name': 'user3'}, 'score': 2.5, 'active': True,
+                                                       'joined': '2020-01-02T03:04:05+00:00'})
+        obj = Product.objects.annotate(user_id=KeyInt('data', 'user__id'), score=KeyFloat('data', 'score'),
+                                       active=KeyBool('data', 'active')).get(name='p3')
+        self.assertEqual(obj.user_id, 3)
+        self.assertEqual(obj.score, 2.5)
+        self.assertIs(obj.active, True)
+        obj = Product.objects.annotate(joined=KeyTimestamp('data', 'joined')).get(name='p3')
+        joined = datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        self.assertEqual(obj.joined, joined if settings.USE_TZ else timezone.make_naive(joined))
+        self.assertEqual(Product.objects.annotate(user_id=KeyInt('data', 'user__id')).filter(user_id__gt=16).count(), 3)
+        obj = Product.objects.annotate(Key('data', 'user__id', output_field=models.BigIntegerField())).get(name='p3')
+        self.assertEqual(obj.data__user__id, 3)
+
+    def test_json_typed_keys_match_index(self):
+        for expression in (KeyInt('data', 'user__id'), Key('data', 'user__id', cast='int4'),
+                           Key('data', 'user__id', output_field=models.IntegerField())):
+            queryset = Product.objects.annotate(user_id=expression).filter(user_id=5)
+            sql, params = queryset.query.sql_with_params()
+            self.assertIn('WHERE (("jsonb_product"."data" #>> %s))::integer = %s', sql)
+            self.assertUsesIndex(queryset, self.get_index_name('key', ('user', 'id'), 'integer'))
+
+    def test_json_key_index_casts(self):
+        field = JSONField(key_indexes=[('joined', 'timestamptz'), ('day', 'date'), ('price', 'numeric(6, 2)'),
+                                       ('count', 'int8')])
+        field.set_attributes_from_name('data')
+        field.model = Product
+        errors = [error for error in field.check() if error.id == 'django_postgres_extensions.E001']
+        self.assertEqual([error.msg for error in errors], [
+            "Key index 'joined' can't be cast to timestamp with time zone in an index.",
+            "Key index 'day' can't be cast to date in an index.",
+        ])
+
+    def test_json_key_index_schema(self):
+        field = Product._meta.get_field('data')
+        name, path, args, kwargs = field.deconstruct()
+        self.assertEqual(kwargs['key_indexes'], ['user__name', ('user__id', 'integer')])
+        self.assertEqual(kwargs['index_opclass'], 'jsonb_path_ops')
+        new_field = JSONField(null=True, blank=True, key_indexes=['user__name'])
+        new_field.set_attributes_from_name('data')
+        with connection.schema_editor(collect_sql=True) as editor:
+            editor.alter_field(Product, field, new_field)
+        sql = '\n'.join(editor.collected_sql)
+        self.assertEqual(sql.count('DROP INDEX'), 2)
+        self.assertNotIn('CREATE INDEX', sql)
@@ -2,7 +2,9 @@ from __future__ import unicode_literals
 
 from operator import attrgetter
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from .models import Person
 
@@ -103,6 +105,25 @@ class RecursiveM2MTests(TestCase):
             self.b.friends.all(), []
         )
 
+    def test_recursive_m2m_clear_only_related_rows(self):
+        def get_ctids():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT id, ctid FROM %s' % connection.ops.quote_name(Person._meta.db_table))
+                return dict(cursor.fetchall())
+
+        ctids = get_ctids()
+        with CaptureQueriesContext(connection) as captured:
+            updated = self.c.friends._clear()
+        self.assertEqual(updated, 2)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertIn('"friends_ids" @> ARRAY[%s]' % self.c.pk, updates[-1])
+        new_ctids = get_ctids()
+        self.assertEqual(new_ctids[self.b.pk], ctids[self.b.pk])
+        for person in (self.a, self.c, self.d):
+            self.assertNotEqual(new_ctids[person.pk], ctids[person.pk])
+        self.assertQuerysetEqual(self.c.friends.all(), [])
+        self.assertQuerysetEqual(self.a.friends.all(), ['Bill', 'David'], attrgetter('name'), ordered=False)
+
     def test_recursive_m2m_clear(self):
         """ Tests the clear method works as expected on m2m fields """
 
@@ -193,3 +214,52 @@ class RecursiveM2MTests(TestCase):
             ],
             attrgetter("name")
         )
+
+    def test_recursive_m2m_delete(self):
+        """ Check that deleting a person removes them from symmetrical and non-symmetrical relations """
+        self.b.idols.add(self.a)
+        self.a.delete()
+        # Who are Bill's friends and idols?
+        self.assertQuerysetEqual(self.b.friends.all(), [], attrgetter("name"))
+        self.assertQuerysetEqual(self.b.idols.all(), [], attrgetter("name"))
+        # Who is friends with David?
+        self.assertQuerysetEqual(
+            self.d.friends.all(), [
+                "Chuck",
+            ],
+            attrgetter("name")
+        )
+        self.assertListEqual(Person.objects.get(pk=self.d.pk).friends_ids, [self.c.pk])
+
+    def test_recursive_m2m_bulk(self):
+        """ Check that the bulk methods keep symmetrical relations in step """
+        Person.friends.bulk_add({self.b: [self.c], self.c: [self.d, self.b]})
+        self.assertListEqual(Person.objects.get(pk=self.b.pk).friends_ids, [self.a.pk, self.c.pk])
+        self.assertListEqual(Person.objects.get(pk=self.c.pk).friends_ids, [self.a.pk, self.d.pk, self.b.pk])
+        Person.friends.bulk_remove({self.a: [self.b, self.c]})
+        self.assertListEqual(Person.objects.get(pk=self.b.pk).friends_ids, [self.c.pk])
+        self.assertListEqual(Person.objects.get(pk=self.c.pk).friends_ids, [self.d.pk, self.b.pk])
+        Person.friends.bulk_set({self.a: [self.b], self.d: []})
+        self.assertListEqual(Person.objects.get(pk=self.a.pk).friends_ids, [self.b.pk])
+        self.assertListEqual(Person.objects.get(pk=self.b.pk).friends_ids, [self.c.pk, self.a.pk])
+        self.assertListEqual(Person.objects.get(pk=self.c.pk).friends_ids, [self.b.pk])
+        self.assertListEqual(Person.objects.get(pk=self.d.pk).friends_ids, [])
+
+    def test_recursive_m2m_set(self):
+        """ Check that set keeps symmetrical relations in step """
+        self.a.friends.set([self.c, self.d, self.b, self.d])
+        self.assertListEqual(Person.objects.get(pk=self.a.pk).friends_ids, [self.c.pk, self.d.pk, self.b.pk])
+        self.a.friends.set([self.d])
+        # Who is friends with Bill?
+        self.assertQuerysetEqual(self.b.friends.all(), [], attrgetter("name"))
+        # Who is friends with Chuck?
+        self.assertQuerysetEqual(self.c.friends.all(), ["David"], attrgetter("name"))
+        # Who is friends with David?
+        self.assertQuerysetEqual(
+            self.d.friends.all(), [
+                "Anne",
+                "Chuck",
+            ],
+            attrgetter("name"),
+            ordered=False
+        )
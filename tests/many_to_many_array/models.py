@@ -37,6 +37,15 @@ class Article(models.Model):
         ordering = ('headline',)
 
 
+@python_2_unicode_compatible
+class UnnestArticle(models.Model):
+    headline = models.CharField(max_length=100)
+    publications = ArrayManyToManyField(Publication, prefetch_strategy='unnest', related_name='unnest_articles')
+
+    def __str__(self):
+        return self.headline
+
+
 # Models to test correct related_name inheritance
 class AbstractArticle(models.Model):
     class Meta:
@@ -1,10 +1,18 @@
 from __future__ import unicode_literals
 
-from django.db import transaction
+import warnings
+
+from django.db import connection, transaction
+from django.db.models import Prefetch, signals
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import six
 
-from .models import Article, InheritedArticleA, InheritedArticleB, Publication
+from django_postgres_extensions.models.deletion import get_array_references
+from django_postgres_extensions.models.fields.related import ArrayManyToManyField
+from django_postgres_extensions.signals import delete_reverse_related, m2m_bulk_changed
+
+from .models import Article, InheritedArticleA, InheritedArticleB, Publication, UnnestArticle
 
 
 class ManyToManyTests(TestCase):
@@ -69,6 +77,21 @@ class ManyToManyTests(TestCase):
                                      '<Publication: The Python Journal>',
                                  ])
 
+    def test_add_existing_and_duplicates(self):
+        a5 = Article.objects.create(headline='Python in the Wild')
+        a5.publications.add(self.p2)
+        a5.publications.add(self.p3, self.p2, self.p1, self.p3)
+        a5.refresh_from_db()
+        self.assertEqual(a5.publications_ids, [self.p2.pk, self.p3.pk, self.p1.pk])
+
+    def test_remove_many(self):
+        publications = [Publication.objects.create(title='Publication %s' % i) for i in range(250)]
+        a5 = Article.objects.create(headline='Python in the Wild')
+        a5.publications.add(self.p1, *publications)
+        a5.publications.remove(*publications[:200])
+        a5.refresh_from_db()
+        self.assertEqual(a5.publications_ids, [self.p1.pk] + [p.pk for p in publications[200:]])
+
     def test_reverse_add(self):
         obj = Article.objects.get(headline='Django lets you build Web apps easily')
         # Adding via the 'other' end of an m2m
@@ -342,6 +365,45 @@ class ManyToManyTests(TestCase):
         self.assertQuerysetEqual(self.p1.article_set.all(),
                                  ['<Article: NASA uses Python>'])
 
+    def test_bulk_delete_single_update(self):
+        # The deleted publications are removed with one UPDATE per referencing array field
+        with CaptureQueriesContext(connection) as captured:
+            Publication.objects.exclude(pk=self.p4.pk).delete()
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), len(get_array_references(Publication)))
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [])
+
+    def test_delete_sends_clear_signals(self):
+        changes = []
+
+        def receiver(**kwargs):
+            changes.append((kwargs['action'], kwargs['instance'].pk, kwargs['reverse'], kwargs['pk_set']))
+
+        signals.m2m_changed.connect(receiver, sender=Article)
+        try:
+            p2_pk, p3_pk, p4_pk = self.p2.pk, self.p3.pk, self.p4.pk
+            self.p2.delete()
+            Publication.objects.filter(pk__in=[p3_pk, p4_pk]).delete()
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=Article)
+        self.assertEqual(changes, [
+            ('pre_clear', p2_pk, True, None),
+            ('post_clear', p2_pk, True, None),
+            ('pre_clear', p3_pk, True, None),
+            ('pre_clear', p4_pk, True, None),
+            ('post_clear', p3_pk, True, None),
+            ('post_clear', p4_pk, True, None),
+        ])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p1.pk])
+
+    def test_delete_reverse_related_deprecated(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            delete_reverse_related(Publication, signals.pre_delete, self.p2, 'default')
+        self.assertEqual(caught[0].category, DeprecationWarning)
+        self.assertQuerysetEqual(self.p2.article_set.all(), [])
+
     def test_remove(self):
         # Removing publication from an article:
         self.assertQuerysetEqual(self.p2.article_set.all(),
@@ -414,6 +476,239 @@ class ManyToManyTests(TestCase):
         self.a4.publications.set([], clear=True)
         self.assertQuerysetEqual(self.a4.publications.all(), [])
 
+    def test_set_single_update(self):
+        changes = []
+
+        def receiver(action, pk_set, **kwargs):
+            stored = Article.objects.get(pk=self.a2.pk).publications_ids
+            changes.append((action, pk_set, stored))
+
+        old_ids = Article.objects.get(pk=self.a2.pk).publications_ids
+        new_ids = [self.p4.pk, self.p1.pk]
+        signals.m2m_changed.connect(receiver, sender=Article.publications.through)
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                self.a2.publications.set([self.p4, self.p1, self.p4])
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=Article.publications.through)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        # The pre_ signals see the array before the write
+        self.assertEqual(changes, [
+            ('pre_remove', [self.p2.pk, self.p3.pk], old_ids),
+            ('post_remove', [self.p2.pk, self.p3.pk], new_ids),
+        ])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p4.pk, self.p1.pk])
+        self.a2.publications.set([self.p2])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p2.pk])
+
+    def test_set_unexpected_kwargs(self):
+        self.assertRaises(TypeError, self.a2.publications.set, [self.p1], bulk=False)
+        self.assertRaises(TypeError, self.p2.article_set.set, [self.a1], bulk=False)
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids,
+                             [self.p1.pk, self.p2.pk, self.p3.pk, self.p4.pk])
+
+    def test_forward_returning_not_supported(self):
+        self.assertRaises(TypeError, self.a1.publications.add, self.p3, returning=True)
+        self.assertRaises(TypeError, self.a2.publications.remove, self.p3, returning=True)
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p1.pk])
+        flags = []
+
+        def receiver(**kwargs):
+            flags.append((kwargs['action'], kwargs['reverse']))
+
+        signals.m2m_changed.connect(receiver, sender=Article.publications.through)
+        try:
+            self.a1.publications.add(self.p3)
+            self.p3.article_set.remove(self.a1)
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=Article.publications.through)
+        self.assertEqual(flags, [('pre_add', False), ('post_add', False), ('pre_remove', True), ('post_remove', True)])
+
+    def test_reverse_add_remove_single_update(self):
+        with CaptureQueriesContext(connection) as captured:
+            changed = self.p3.article_set.add(self.a1, self.a2, self.a3, returning=True)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('= ANY(', updates[0])
+        self.assertEqual(sorted(changed), sorted([self.a1.pk, self.a3.pk]))
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p1.pk, self.p3.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids,
+                             [self.p1.pk, self.p2.pk, self.p3.pk, self.p4.pk])
+        with CaptureQueriesContext(connection) as captured:
+            changed = self.p3.article_set.remove(self.a2, self.a3, self.a4, returning=True)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(sorted(changed), sorted([self.a2.pk, self.a3.pk]))
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p1.pk, self.p2.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [self.p2.pk])
+        self.assertIsNone(self.p3.article_set.add(self.a4))
+
+    def test_pk_any_lookup(self):
+        pks = [self.p1.pk, self.p3, self.p4.pk, None]
+        with CaptureQueriesContext(connection) as captured:
+            publications = list(Publication.objects.filter(pk__any=pks))
+        self.assertEqual(publications, [self.p4, self.p3, self.p1])
+        self.assertIn('= ANY(', captured.captured_queries[0]['sql'])
+        self.assertQuerysetEqual(Publication.objects.filter(pk__any=[]), [])
+        self.assertQuerysetEqual(Publication.objects.filter(title__any=['Science News', 'Science Weekly']), [
+            '<Publication: Science News>',
+            '<Publication: Science Weekly>',
+        ])
+        subquery = Article.objects.filter(headline__startswith='NASA').values('pk')
+        self.assertQuerysetEqual(Article.objects.filter(pk__any=subquery), [
+            '<Article: NASA finds intelligent life on Earth>',
+            '<Article: NASA uses Python>',
+        ])
+        self.assertEqual(Publication.objects.filter(pk__any=Publication.objects.all()).count(), 4)
+        self.assertQuerysetEqual(Publication.objects.filter(title__any='Science News'), [
+            '<Publication: Science News>',
+        ])
+        self.assertEqual(Publication.objects.filter(pk__any=self.p1).get(), self.p1)
+
+    def test_join_strategies(self):
+        field = Article._meta.get_field('publications')
+        reverse = Publication.objects.filter(article__headline__startswith='NASA').distinct()
+        self.assertIn('@> ARRAY[', str(reverse.query))
+        expected_reverse = list(reverse)
+        forward = Article.objects.filter(publications__title__startswith='Science').distinct()
+        expected_forward = list(forward)
+        self.assertEqual(len(expected_reverse), 4)
+        self.assertEqual(len(expected_forward), 3)
+        for join_strategy, sql in (('any', '= ANY('), ('unnest', 'LATERAL UNNEST(')):
+            field.join_strategy = join_strategy
+            try:
+                self.assertIn(sql, str(forward.query))
+                self.assertEqual(list(forward.all()), expected_forward)
+                self.assertEqual(list(reverse.all()), expected_reverse)
+            finally:
+                field.join_strategy = 'auto'
+        with self.assertRaises(ValueError):
+            ArrayManyToManyField(Publication, join_strategy='hash')
+
+    def test_bulk_add(self):
+        changes = []
+
+        def receiver(action, pk_sets, **kwargs):
+            changes.append((action, dict(pk_sets)))
+
+        m2m_bulk_changed.connect(receiver, sender=Article.publications.through)
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                Article.publications.bulk_add({
+                    self.a1: [self.p2, self.p1, self.p2],
+                    self.a3.pk: [self.p3.pk, self.p4],
+                    self.a4: [self.p3],
+                }, batch_size=2)
+        finally:
+            m2m_bulk_changed.disconnect(receiver, sender=Article.publications.through)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(changes, [
+            ('pre_add', {self.a1.pk: [self.p2.pk, self.p1.pk], self.a3.pk: [self.p3.pk, self.p4.pk]}),
+            ('post_add', {self.a1.pk: [self.p2.pk, self.p1.pk], self.a3.pk: [self.p3.pk, self.p4.pk]}),
+            ('pre_add', {self.a4.pk: [self.p3.pk]}),
+            ('post_add', {self.a4.pk: [self.p3.pk]}),
+        ])
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p1.pk, self.p2.pk])
+        self.assertListEqual(
+            Article.objects.get(pk=self.a3.pk).publications_ids, [self.p2.pk, self.p3.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a4.pk).publications_ids, [self.p2.pk, self.p3.pk])
+
+    def test_bulk_remove(self):
+        Article.publications.bulk_remove({self.a2: [self.p1, self.p3], self.a3: [self.p2, self.p4]})
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p2.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [])
+        self.assertListEqual(Article.objects.get(pk=self.a4.pk).publications_ids, [self.p2.pk])
+
+    def test_bulk_set(self):
+        changes = []
+
+        def receiver(action, pk_sets, **kwargs):
+            # pre_ signals are sent before the arrays are written
+            changes.append((action, dict(pk_sets), Article.objects.get(pk=self.a2.pk).publications_ids))
+
+        old_ids = [self.p1.pk, self.p2.pk, self.p3.pk, self.p4.pk]
+        m2m_bulk_changed.connect(receiver, sender=Article.publications.through)
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                Article.publications.bulk_set({self.a1: [self.p3, self.p1], self.a2: [self.p4]})
+        finally:
+            m2m_bulk_changed.disconnect(receiver, sender=Article.publications.through)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('= ANY(', captured.captured_queries[0]['sql'])
+        self.assertIn('::integer[]) FOR UPDATE', captured.captured_queries[0]['sql'])
+        self.assertEqual(changes, [
+            ('pre_remove', {self.a2.pk: [self.p1.pk, self.p2.pk, self.p3.pk]}, old_ids),
+            ('pre_add', {self.a1.pk: [self.p3.pk]}, old_ids),
+            ('post_remove', {self.a2.pk: [self.p1.pk, self.p2.pk, self.p3.pk]}, [self.p4.pk]),
+            ('post_add', {self.a1.pk: [self.p3.pk]}, [self.p4.pk]),
+        ])
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p3.pk, self.p1.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p4.pk])
+        with self.assertRaises(ValueError):
+            Publication.article_set.bulk_set({self.p1: [self.a1]})
+
+    def test_intarray_keeps_order(self):
+        field = Article._meta.get_field('publications')
+        field.intarray = True
+        connection.installed_extensions = frozenset(['intarray'])
+        try:
+            self.assertTrue(field.uses_intarray(connection))
+            with CaptureQueriesContext(connection) as captured:
+                self.a1.publications.add(self.p4, self.p2)
+                self.a2.publications.remove(self.p1, self.p3)
+                self.p3.article_set.add(self.a1)
+                self.p4.article_set.remove(self.a2)
+                Article.publications.bulk_add({self.a3: [self.p4, self.p1]})
+        finally:
+            field.intarray = None
+            del connection.installed_extensions
+        for query in captured.captured_queries:
+            self.assertNotIn(' | ', query['sql'])
+            self.assertNotIn(' - ', query['sql'])
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids,
+                             [self.p1.pk, self.p4.pk, self.p2.pk, self.p3.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p2.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [self.p2.pk, self.p4.pk, self.p1.pk])
+
+    def get_ctids(self):
+        # A row gets a new ctid whenever it's updated
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, ctid FROM %s' % connection.ops.quote_name(Article._meta.db_table))
+            return dict(cursor.fetchall())
+
+    def test_reverse_clear_only_related_rows(self):
+        ctids = self.get_ctids()
+        with CaptureQueriesContext(connection) as captured:
+            updated = self.p2.article_set._clear()
+        self.assertEqual(updated, 3)
+        updates = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"publications_ids" @> ARRAY[%s]' % self.p2.pk, updates[0])
+        new_ctids = self.get_ctids()
+        self.assertEqual(new_ctids[self.a1.pk], ctids[self.a1.pk])
+        for article in (self.a2, self.a3, self.a4):
+            self.assertNotEqual(new_ctids[article.pk], ctids[article.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p1.pk, self.p3.pk, self.p4.pk])
+
+    def test_bulk_empty(self):
+        with self.assertNumQueries(0):
+            Article.publications.bulk_add({})
+            Article.publications.bulk_remove({})
+            Article.publications.bulk_set({})
+            Publication.article_set.bulk_add({})
+
+    def test_bulk_reverse(self):
+        Publication.article_set.bulk_add({self.p3: [self.a1, self.a3], self.p4: [self.a1]})
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p1.pk, self.p3.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [self.p2.pk, self.p3.pk])
+        Publication.article_set.bulk_remove({self.p1: [self.a1, self.a2], self.p3: [self.a3]})
+        self.assertListEqual(Article.objects.get(pk=self.a1.pk).publications_ids, [self.p3.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a2.pk).publications_ids, [self.p2.pk, self.p3.pk, self.p4.pk])
+        self.assertListEqual(Article.objects.get(pk=self.a3.pk).publications_ids, [self.p2.pk])
+
     def test_assign(self):
         # Relation sets can be assigned using set().
         self.p2.article_set.set([self.a4, self.a3])
@@ -519,3 +814,66 @@ class ManyToManyTests(TestCase):
                                  [
                                      '<Publication: Science Weekly>',
                                  ])
+
+    def test_prefetch_related_order(self):
+        a5 = Article.objects.create(headline='Python in the Wild')
+        a5.publications.add(self.p3, self.p1, self.p2)
+        # The related model's ordering is kept when the queryset is ordered
+        with self.assertNumQueries(2):
+            article = Article.objects.prefetch_related('publications').get(pk=a5.pk)
+            self.assertQuerysetEqual(article.publications.all(),
+                                     [
+                                         '<Publication: Science News>',
+                                         '<Publication: Science Weekly>',
+                                         '<Publication: The Python Journal>',
+                                     ])
+        # Otherwise the order of the array is kept
+        prefetch = Prefetch('publications', queryset=Publication.objects.order_by())
+        with self.assertNumQueries(2):
+            article = Article.objects.prefetch_related(prefetch).get(pk=a5.pk)
+            self.assertEqual(list(article.publications.all()), [self.p3, self.p1, self.p2])
+        with self.assertNumQueries(2):
+            publication = Publication.objects.prefetch_related('article_set').get(pk=self.p2.pk)
+            self.assertQuerysetEqual(publication.article_set.all(),
+                                     [
+                                         '<Article: NASA finds intelligent life on Earth>',
+                                         '<Article: NASA uses Python>',
+                                         '<Article: Oxygen-free diet works wonders>',
+                                         '<Article: Python in the Wild>',
+                                     ])
+
+    def test_prefetch_related_duplicate_pks(self):
+        a5 = Article.objects.create(headline='Python in the Wild',
+                                    publications_ids=[self.p3.pk, self.p3.pk, self.p1.pk])
+        a6 = UnnestArticle.objects.create(headline='Python in the Wild', publications_ids=[self.p3.pk, self.p3.pk])
+        prefetch = Prefetch('publications', queryset=Publication.objects.order_by())
+        article = Article.objects.prefetch_related(prefetch).get(pk=a5.pk)
+        self.assertEqual(list(article.publications.all()), [self.p3, self.p1])
+        article = UnnestArticle.objects.prefetch_related(prefetch).get(pk=a6.pk)
+        self.assertEqual(list(article.publications.all()), [self.p3])
+        publication = Publication.objects.prefetch_related('article_set').get(pk=self.p3.pk)
+        self.assertEqual([article.pk for article in publication.article_set.all()].count(a5.pk), 1)
+
+    def test_prefetch_related_unnest(self):
+        a1 = UnnestArticle.objects.create(headline='Python in the Wild')
+        a1.publications.add(self.p3, self.p1, self.p2)
+        a2 = UnnestArticle.objects.create(headline='NASA uses Python')
+        a2.publications.add(self.p2, self.p4)
+        a3 = UnnestArticle.objects.create(headline='No publications')
+        prefetch = Prefetch('publications', queryset=Publication.objects.order_by())
+        with self.assertNumQueries(2):
+            articles = list(UnnestArticle.objects.order_by('pk').prefetch_related(prefetch))
+            self.assertEqual([list(a.publications.all()) for a in articles],
+                             [[self.p3, self.p1, self.p2], [self.p2, self.p4], []])
+        self.assertEqual(articles[0].publications.all()[2]._prefetch_related_position, 3)
+        with self.assertNumQueries(2):
+            article = UnnestArticle.objects.prefetch_related('publications').get(pk=a2.pk)
+            self.assertQuerysetEqual(article.publications.all(),
+                                     [
+                                         '<Publication: Highlights for Children>',
+                                         '<Publication: Science News>',
+                                     ])
+        with self.assertNumQueries(2):
+            publication = Publication.objects.prefetch_related('unnest_articles').get(pk=self.p2.pk)
+            self.assertEqual(set(publication.unnest_articles.all()), {a1, a2})
+        self.assertEqual(a3.publications.count(), 0)